@@ -115,13 +115,80 @@ template, like so:
     res = tmpl1 + tmpl2
 
 results in a copy of tmpl1 with values from tmpl2 added, only where tmpl1
-doesn't already have the given key.  Multiplying templates, like so:
+doesn't already have the given key.  Context(tmpl1, tmpl2) gives the same
+lookups without making the copy, and is what makesite itself uses.
+Multiplying templates, like so:
 
     res = tmpl1 * tmpl2
 
 returns a string which is the result of applying the source file (tmpl2)
 to the template file (tmpl1) as given above.
 
+A whole build may also be run in-process, without paying interpreter
+startup for every site:
+
+    import makesite
+    makesite.Build(directory = "website/.master")
+
+Build() takes the same settings as the command line (template_file,
+filenames, directory, module_file, norc, force, verbose) and returns the
+number of pages written.  --timing reports the module load and build
+times on stderr, so startup cost can be tracked.
+
+Large builds may be split across machines.  --shard=i/N builds only the
+sources which fall in shard i of N (by a CRC of the file name, so every
+machine agrees), and lists the outputs in a manifest: .manifest.i, or
+the file named by --manifest.  Collect the outputs and manifests in one
+tree and combine the manifests with
+
+    makesite.py --merge=.manifest .manifest.0 .manifest.1 ...
+
+which checks that every shard is present, that no output was built
+twice, and that all shards used the same templates.  publish.py can
+read the merged manifest (see its manifest setting).
+
+--recursive builds a whole source tree in one run, in place of one run
+per directory.  Every directory below the build directory (except dot
+directories) is searched for templates and source files.  A template
+applies to its own directory and all those below it, until a template
+of the same file name in a subdirectory replaces it; a .default in a
+subdirectory adds to, and overrides, the one above it, and a module
+file (module.site) replaces the inherited one.  Each template is read
+only once.  A template's Target is taken relative to the directory the
+template was found in, and the source tree below that directory is
+mirrored under the target, so with
+
+    .master/template.site       (Target: ../)
+    .master/docs/intro.src
+
+intro.src is built as docs/intro.html beside .master.  Source, output
+and module paths are relative to the build directory, which is also
+the current directory when module code runs.  makesite.WorkList()
+returns the planned pages without building them or writing any files.
+
+Two more headers, in the template or in .default, turn on a stage which
+runs after pages are rendered:
+
+    Minify:      extensions of output files to minify, from html, htm,
+                 shtml, css and js (say, "html css js").  Comments and
+                 surplus white space are removed, conservatively.
+    Fingerprint: glob patterns, relative to the Target directory, of
+                 static files to fingerprint (say, "css/*.css img/*").
+
+Each fingerprinted file is copied to a name carrying a hash of its
+content, such as css/site.3f09a1c2d4.css, so that it can be served with
+a long cache lifetime; older copies are removed.  Pages refer to it
+through a macro named for the original path,
+
+    <link rel="stylesheet" href="<!--%asset:css/site.css%-->">
+
+which expands to the fingerprinted name, relative to the page.  The
+copies are made as the first page using them is built.  When an
+asset changes, the pages using the template are rebuilt.  Minifying is
+done on --jobs worker processes (default 4) while rendering goes on.
+Results are cached by content hash in .makecache, so only changed
+output is minified again; the cache may be deleted at any time.
+
 When input filename begins with a $ (dollar sign) it will be removed
 from the output filename.  This is handy for creating dotfiles.
 """
@@ -133,7 +200,14 @@ __version__ = "2.0"
 # module imports
 ######################################################################
 
-import glob, re, string, sys, getopt, os, time, stat, UserDict
+import time
+
+_load_start = time.time()
+
+import re, string, sys, os, stat, UserDict
+
+# glob and getopt are imported where they are used, so that importing
+# makesite as a library (see Build() below) stays cheap.
 
 ######################################################################
 # exceptions
@@ -157,8 +231,10 @@ class DataError(Error):
 
 _verbose = None
 _force = None
+_pipeline = None
 _pause = None
 _directory = "."
+_module_file = "module.site"
 
 class Generic:
     pass
@@ -238,56 +314,22 @@ class Template(UserDict.UserDict):
 
     def __delitem__(self, key):
         key = str(key)
-        return UserDict.UserDict.__setitem__(self, string.lower(key), value)
+        return UserDict.UserDict.__delitem__(self, string.lower(key))
 
     def has_key(self, key):
         key = str(key)
         return UserDict.UserDict.has_key(self, string.lower(key))
 
-    def get(self, key, default):
-        key = str(key)
+    def get(self, key, default = None):
         try:
-            rc = self.__getitem__(self, string.lower(key))
+            rc = self.__getitem__(key)
         except KeyError:
             rc = default
         return rc
 
-    def __process(self, alt_ctx, lines, out, depth):
-        if type(lines) is type(""):
-            lines = [ lines ]
-        if depth > 6:
-            print "recursive definition error:", lines[0]
-            return
-        for line in lines:
-            while line:
-                mo = Macro.search(line)
-                emo = ExecMacro.search(line)
-                if mo and emo and emo.start() < mo.start():
-                    mo = None
-                if mo:
-                    key = mo.group(1)
-                    out.append(line[:mo.start()])
-                    if alt_ctx.has_key(key):
-                        alt_ctx.__process(self, alt_ctx[key], out, depth + 1)
-                    elif self.has_key(key):
-                        alt_ctx.__process(self, self[key], out, depth + 1)
-                    elif alt_ctx.has_key("def" + key):
-                        alt_ctx.__process(self, alt_ctx["def"+key], out, depth + 1)
-                    elif _verbose:  ### fix this ugly hack
-                        print "WARNING-- missing key <%s>" % key
-                    line = line[mo.end():]
-                elif emo:
-                    key = emo.group(1)
-                    out.append(line[:emo.start()])
-                    try:
-                        out.append(getattr(self["_module"], key)(self, alt_ctx))
-                    except KeyError:
-                        out.append(getattr(alt_ctx["_module"], key)(alt_ctx, self))
-                    line = line[emo.end():]
-                else:
-                    out.append(line)
-                    line = ''
-        depth -= 1
+    def _lookup(self, key):
+        # key must already be lowercase
+        return self.data[key]
 
     def __add__(self, other):
         # adding is defined strictly for applying defaults
@@ -304,10 +346,169 @@ class Template(UserDict.UserDict):
         if not isinstance(other, Template):
             raise TypeError, 'can only "multiply" a Template by a Template'
         lst = []
-        self.__process(other, self["body"], lst, 0)
+        _process(self, other, self["body"], lst, 0)
         return string.join(lst, "")
 
 
+_deleted = []          # marks a key deleted in a Context's overlay
+
+class Context(UserDict.DictMixin):
+    """Context is a chain of Templates, searched in order.
+
+    Context(tmpl, def_ctx) answers lookups the way tmpl + def_ctx does,
+    but without copying either one, and it sees later changes to them.
+    Keys are stored lowercase when a Template is loaded, so lookups go
+    straight to the underlying dictionaries.
+
+    It is a full mapping, as the Template copy it replaces was, so exec
+    macros may test, list and change it.  Changes go to an overlay of
+    its own; the Templates it chains are never modified.
+    """
+
+    def __init__(self, *layers):
+        self.layers = layers
+        self.overlay = {}
+        self.maps = [ self.overlay ] + map(lambda l: l.data, layers)
+
+    def _lookup(self, key):
+        # key must already be lowercase
+        for m in self.maps:
+            if m.has_key(key):
+                v = m[key]
+                if v is _deleted:
+                    break
+                return v
+        raise KeyError, key
+
+    def __getitem__(self, key):
+        return self._lookup(string.lower(str(key)))
+
+    def __setitem__(self, key, value):
+        self.overlay[string.lower(str(key))] = value
+
+    def __delitem__(self, key):
+        key = string.lower(str(key))
+        self._lookup(key)
+        self.overlay[key] = _deleted
+
+    def has_key(self, key):
+        try:
+            self._lookup(string.lower(str(key)))
+        except KeyError:
+            return False
+        return True
+
+    __contains__ = has_key
+
+    def get(self, key, default = None):
+        try:
+            rc = self.__getitem__(key)
+        except KeyError:
+            rc = default
+        return rc
+
+    def keys(self):
+        d = {}
+        maps = self.maps[:]
+        maps.reverse()
+        for m in maps:
+            d.update(m)
+        return filter(lambda k, d = d: d[k] is not _deleted, d.keys())
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def copy(self):
+        res = Template()
+        for k in self.keys():
+            res[k] = self[k]
+        return res
+
+    def __add__(self, other):
+        return self.copy() + other
+
+    def __mul__(self, other):
+        if not isinstance(other, Template):
+            raise TypeError, 'can only "multiply" a Context by a Template'
+        lst = []
+        _process(self, other, self["body"], lst, 0)
+        return string.join(lst, "")
+
+
+######################################################################
+# macro processing
+######################################################################
+
+# each line of text is split into literal strings and macro tuples
+# once, and the result is kept here; the cache is bounded since page
+# bodies are seldom seen twice.
+
+_compiled = {}
+_compiled_max = 20000
+
+AnyMacro = re.compile(r'<!--%(.*?)%-->|<!--!(.*?)!-->')
+
+def _compile(line):
+    try:
+        return _compiled[line]
+    except KeyError:
+        pass
+    tokens = []
+    pos = 0
+    for mo in AnyMacro.finditer(line):
+        if mo.start() > pos:
+            tokens.append(line[pos:mo.start()])
+        key = mo.group(1)
+        if key is not None:
+            lkey = string.lower(key)
+            tokens.append((1, key, lkey, "def" + lkey))
+        else:
+            tokens.append((2, mo.group(2)))
+        pos = mo.end()
+    if pos < len(line):
+        tokens.append(line[pos:])
+    if len(_compiled) >= _compiled_max:
+        _compiled.clear()
+    _compiled[line] = tokens
+    return tokens
+
+def _process(ctx, alt_ctx, lines, out, depth):
+    # a macro is looked up in alt_ctx, then ctx, then as "def" + name
+    # in alt_ctx; whatever is found is expanded with the two contexts
+    # swapped.
+    if type(lines) is type(""):
+        lines = [ lines ]
+    if depth > 6:
+        print "recursive definition error:", lines[0]
+        return
+    for line in lines:
+        for tok in _compile(line):
+            if type(tok) is type(""):
+                out.append(tok)
+            elif tok[0] == 1:
+                try:
+                    value = alt_ctx._lookup(tok[2])
+                except KeyError:
+                    try:
+                        value = ctx._lookup(tok[2])
+                    except KeyError:
+                        try:
+                            value = alt_ctx._lookup(tok[3])
+                        except KeyError:
+                            if _verbose:  ### fix this ugly hack
+                                print "WARNING-- missing key <%s>" % tok[1]
+                            continue
+                _process(alt_ctx, ctx, value, out, depth + 1)
+            else:
+                try:
+                    out.append(getattr(ctx["_module"], tok[1])(ctx, alt_ctx))
+                except KeyError:
+                    out.append(getattr(alt_ctx["_module"], tok[1])(alt_ctx, ctx))
+
+
 def LoadTemplate(template_file):
     try:
         t_in = open(template_file, "r")
@@ -319,10 +520,15 @@ def LoadTemplate(template_file):
     return tmpl
 
 
-def defaultctx():
+def defaultctx(directory = ".", parent = None):
+    # a .default in directory is layered over the parent's defaults
     try:
-        def_ctx = LoadTemplate(".default")
+        def_ctx = LoadTemplate(_join(directory, ".default"))
+        if parent is not None:
+            def_ctx = def_ctx + parent
     except:
+        if parent is not None:
+            return parent
         def_ctx = Template()
     
     def_ctx["Date"] = time.strftime("%m/%d/%Y", time.localtime(time.time()))
@@ -331,7 +537,16 @@ def defaultctx():
     return def_ctx
 
 
-def _loadmodule(filename):
+def _join(directory, name):
+    # builds in the current directory keep their plain file names
+    if directory == ".":
+        return name
+    return os.path.join(directory, name)
+
+
+def _loadmodule(filename, module_file = None):
+    if module_file is None:
+        module_file = _module_file
     mod = Generic()
     try:
         fp = open(module_file, "r")
@@ -350,7 +565,11 @@ def _loadmodule(filename):
     return mod
 
 
-def MakeSite(tmpl, filename):
+def _work(tmpl, filename, def_ctx, module_file, shard, srcdir = "."):
+    # lists the pages tmpl builds from srcdir, as tuples of
+    # (infile, outfile, modfile, tmpl, def_ctx, module_file, assets),
+    # where assets is None or the arguments of Pipeline.assets(); the
+    # assets are fingerprinted when the first page using them is built
 
     try:
         exts = tmpl["Extension"]
@@ -385,81 +604,779 @@ def MakeSite(tmpl, filename):
         except KeyError:
             target = "./" 
 
+    anchor = target
+
+    if srcdir != ".":
+        # Target is relative to the template's own directory, and the
+        # tree below that is mirrored under it
+        base = tmpl.get("_dir", srcdir)
+        anchor = os.path.join(base, target)
+        target = os.path.normpath(os.path.join(anchor,
+            os.path.relpath(srcdir, base))) + os.sep
+
+    assets = None
+    patterns = _setting(tmpl, def_ctx, "Fingerprint")
+    if patterns:
+        assets = (patterns, anchor, target, _setting(tmpl, def_ctx, "Minify"))
+
     if filename:
         files = [ filename ]
     else:
-        files = glob.glob("*" + ext)
+        import glob
+        files = glob.glob(_join(srcdir, "*" + ext))
         files.sort()
 
+    if shard is not None:
+        files = filter(lambda f, shard = shard: InShard(f, shard), files)
+
+    work = []
+
     for infile in files:
 
         rootname = infile[:-1 * len(ext)]
 
+        # named files keep their own directory, as they always have;
+        # in a tree walk the directory is already in target
         outfile = rootname + tgtext
+        if srcdir != ".":
+            outfile = os.path.basename(outfile)
         if outfile[:1] == '$':
             outfile = outfile[1:]
         outfile = target + outfile
 
-        msg = LoadTemplate(infile)
+        work.append((infile, outfile, rootname + modext, tmpl, def_ctx,
+            module_file, assets))
+
+    return work
+
+
+def _render(job, manifest = None):
+    # builds one page from _work(); returns 1 if it was written
+
+    infile, outfile, modfile, tmpl, def_ctx, module_file, assets = job
+
+    if assets is not None:
+        patterns, anchor, pagedir, minify = assets
+        assets = _getpipeline().assets(patterns, anchor, pagedir, minify)
+
+    msg = LoadTemplate(infile)
+
+    mod = _loadmodule(modfile, module_file)
+
+    try:
+        msg = mod._prefilter(msg)
+    except AttributeError:
+        pass
+
+    msg["_module"] = mod
+
+    try:
+        fp = open(outfile, "r")
+        tstamp = stampof(fp)
+        fp.close()
+    except:
+        tstamp = 0
+
+    stamp = max(msg["_stamp"], tmpl["_stamp"])
+    if assets is not None:
+        stamp = max(stamp, assets["_stamp"])
+
+    if not _force and tstamp > stamp:
+        if _verbose:
+            print "*** skipping", infile
+        if manifest is not None:
+            fp = open(outfile, "rb")
+            res = fp.read()
+            fp.close()
+            manifest.append(_manifest_entry(outfile, res, infile,
+                msg["_stamp"], tmpl))
+        return 0
+
+    print infile, "->", outfile
+
+    def_ctx["SrcDate"] = time.strftime("%m/%d/%Y", \
+        time.localtime(os.stat(infile)[stat.ST_MTIME]))
+
+    if assets is None:
+        res = Context(tmpl, def_ctx) * msg
+    else:
+        res = Context(tmpl, def_ctx, assets) * msg
+
+    outdir = os.path.dirname(outfile)
+    if outdir and not os.path.isdir(outdir):
+        os.makedirs(outdir)
+
+    ext = _extof(outfile)
+    if _minifiers.has_key(ext) \
+    and ext in string.split(string.lower(_setting(tmpl, def_ctx, "Minify"))):
+        # written, and listed in the manifest, once it is minified
+        _getpipeline().page(outfile, res, ext, manifest,
+            (infile, msg["_stamp"], tmpl))
+        return 1
+
+    f_out = open(outfile, "w")
+    f_out.write(res)
+    f_out.close()
+
+    if manifest is not None:
+        manifest.append(_manifest_entry(outfile, res, infile,
+            msg["_stamp"], tmpl))
+
+    return 1
+
 
-        mod = _loadmodule(rootname + modext)
+def MakeSite(tmpl, filename, def_ctx = None, module_file = None,
+             shard = None, manifest = None):
 
+    global _pipeline
+
+    if def_ctx is None:
+        def_ctx = defaultctx()
+
+    built = 0
+
+    # a pipeline started here (rather than by Build) is finished here
+    private = _pipeline is None
+
+    try:
+        for job in _work(tmpl, filename, def_ctx, module_file, shard):
+            built += _render(job, manifest)
+        if private and _pipeline is not None:
+            _pipeline.finish()
+    finally:
+        if private and _pipeline is not None:
+            _pipeline.abort()
+            _pipeline = None
+
+    return built
+
+
+def WorkList(template_file = "template.*", module_file = "module.site",
+             shard = None, filenames = None):
+    """WorkList(...) -- plan a recursive build of the current directory
+
+    Walks the tree once, skipping dot directories, and returns the pages
+    to build from every directory in one list.  Each template is loaded
+    once, where it is found, and applies to that directory and those
+    below it until a template of the same name replaces it; likewise a
+    .default is layered over the one above it, and a module file found
+    in a directory replaces the inherited one.  filenames, if given,
+    limits the list to those source paths.
+    """
+
+    import glob
+
+    wanted = None
+    if filenames:
+        wanted = {}
+        for f in filenames:
+            wanted[os.path.normpath(f)] = 1
+
+    work = []
+    stack = [ (".", {}, None, module_file) ]
+
+    while stack:
+        srcdir, inherited, parent, modfile = stack.pop()
+
+        templates = inherited.copy()
+        for t in glob.glob(_join(srcdir, template_file)):
+            print "Processing Template", t
+            tmpl = LoadTemplate(t)
+            tmpl["_dir"] = srcdir
+            templates[os.path.basename(t)] = tmpl
+
+        if parent is None:
+            def_ctx = defaultctx(srcdir)
+        else:
+            def_ctx = defaultctx(srcdir, parent)
+
+        if srcdir != "." and os.path.exists(_join(srcdir, module_file)):
+            modfile = _join(srcdir, module_file)
+
+        names = templates.keys()
+        names.sort()
+        for n in names:
+            for job in _work(templates[n], None, def_ctx, modfile, shard,
+                             srcdir):
+                if wanted is None or wanted.has_key(os.path.normpath(job[0])):
+                    work.append(job)
+
+        subdirs = []
+        for n in os.listdir(srcdir):
+            path = _join(srcdir, n)
+            if n[:1] != "." and os.path.isdir(path) \
+                    and not os.path.islink(path):
+                subdirs.append(path)
+        subdirs.sort()
+        subdirs.reverse()
+        for path in subdirs:
+            stack.append((path, templates, def_ctx, modfile))
+
+    return work
+
+
+######################################################################
+# post-render pipeline
+######################################################################
+
+# The minifiers are deliberately conservative: they only remove what
+# can't change the meaning of the file, so strings, <pre> blocks and
+# the like are left alone.  Bump _minify_version when they change, so
+# cached results are not reused.
+
+_minify_version = "4"
+
+_css_token = re.compile(r'("(?:\\.|[^"\\])*"|\'(?:\\.|[^\'\\])*\')|(/\*(?!!).*?\*/)', re.S)
+_css_space = re.compile(r'\s*([{};,])\s*')
+_html_keep = re.compile(r'(<(pre|textarea|script|style)\b.*?</\2\s*>)', re.S | re.I)
+_html_comment = re.compile(r'<!--(?!\[if|#|!|<!).*?-->', re.S)
+_html_tag = re.compile(r'<[A-Za-z/!?](?:"[^"]*"|\'[^\']*\'|[^\'">])*>')
+_space_nl = re.compile(r'[ \t\r\f\v]*\n\s*')
+_space = re.compile(r'[ \t\r\f\v]+')
+
+def _css_squeeze(text):
+    # white space, and a last ; before }, outside strings and comments
+    text = _css_space.sub(r'\1', _space.sub(" ", _space_nl.sub(" ", text)))
+    return string.replace(text, ";}", "}")
+
+def _minify_css(data):
+    out = []
+    pos = 0
+    for mo in _css_token.finditer(data):
+        out.append(_css_squeeze(data[pos:mo.start()]))
+        if mo.group(1):
+            out.append(mo.group(1))
+        pos = mo.end()
+    out.append(_css_squeeze(data[pos:]))
+    return string.strip(string.join(out, ""))
+
+def _minify_js(data):
+    # without a real parser, only indentation, trailing blanks, empty
+    # lines and whole-line // comments go; newlines stay, since they may
+    # end statements.  Template literals could span lines, so files
+    # using them are left as they are; so are the lines following a
+    # line ending in \, which may be the rest of a string.
+    if string.find(data, "`") >= 0:
+        return data
+    out = []
+    continued = 0
+    for line in string.split(data, "\n"):
+        if continued:
+            out.append(line)
+        else:
+            line = string.strip(line)
+            if line and line[:2] != "//":
+                out.append(line)
+        continued = string.rstrip(line, "\r")[-1:] == "\\"
+    return string.join(out, "\n") + "\n"
+
+def _html_squeeze(text):
+    # runs of white space in the text between tags; the tags themselves,
+    # attribute values included, are left as they are
+    out = []
+    pos = 0
+    for mo in _html_tag.finditer(text):
+        out.append(_space.sub(" ", _space_nl.sub("\n", text[pos:mo.start()])))
+        out.append(mo.group(0))
+        pos = mo.end()
+    out.append(_space.sub(" ", _space_nl.sub("\n", text[pos:])))
+    return string.join(out, "")
+
+def _minify_html(data):
+    # comments go, except conditional comments and server side includes;
+    # runs of white space outside tags shrink to one newline or space
+    out = []
+    pos = 0
+    for mo in _html_keep.finditer(data):
+        out.append(_html_squeeze(_html_comment.sub("", data[pos:mo.start()])))
+        out.append(mo.group(1))
+        pos = mo.end()
+    out.append(_html_squeeze(_html_comment.sub("", data[pos:])))
+    return string.join(out, "")
+
+_minifiers = {
+    "css": _minify_css,
+    "js": _minify_js,
+    "html": _minify_html,
+    "htm": _minify_html,
+    "shtml": _minify_html,
+}
+
+def _minify(args):
+    # runs in a worker process
+    ext, data = args
+    return _minifiers[ext](data)
+
+def _extof(filename):
+    return string.lower(os.path.splitext(filename)[1][1:])
+
+def _setting(tmpl, def_ctx, key):
+    # a build setting from the template's headers, or from .default
+    try:
+        return tmpl[key]
+    except KeyError:
+        return def_ctx.get(key, "")
+
+_fingerprinted = re.compile(r'\.[0-9a-f]{10}$')
+
+def _getpipeline():
+    global _pipeline
+    if _pipeline is None:
+        _pipeline = Pipeline()
+    return _pipeline
+
+
+class Pipeline:
+    """Pipeline minifies rendered pages and fingerprints static assets.
+
+    Pages are handed over as they are rendered and minified on a pool
+    of jobs worker processes, while rendering goes on; finish() writes
+    the last of them.  Results are cached under cachedir by a hash of
+    their input, so a page which renders the same as before costs no
+    minifying.  Assets are copied to names carrying a hash of their
+    content, and the new names are offered to the pages as macros.
+    """
+
+    def __init__(self, jobs = 4, cachedir = ".makecache"):
+        self.jobs = jobs
+        self.cachedir = cachedir
+        self.pool = None
+        self.pending = []
+        self.maps = {}
+        self.layers = {}
+        self.hashes = None
+        self.hashes_changed = 0
+
+    def _cached(self, ext, data):
+        import hashlib
+        digest = hashlib.sha1(_minify_version + ext + "\0" + data).hexdigest()
+        return os.path.join(self.cachedir, digest + "." + ext)
+
+    def _store(self, cachefile, data):
+        if not os.path.isdir(self.cachedir):
+            os.mkdir(self.cachedir)
+        tmp = "%s.%d.tmp" % (cachefile, os.getpid())
+        fp = open(tmp, "wb")
+        fp.write(data)
+        fp.close()
+        os.rename(tmp, cachefile)
+
+    def minify(self, ext, data):
+        # minifies data here and now, through the cache
+        cachefile = self._cached(ext, data)
         try:
-            msg = mod._prefilter(msg)
-        except AttributeError:
+            fp = open(cachefile, "rb")
+            res = fp.read()
+            fp.close()
+            return res
+        except IOError:
             pass
+        res = _minify((ext, data))
+        self._store(cachefile, res)
+        return res
 
-        msg["_module"] = mod
+    def page(self, outfile, data, ext, manifest = None, source = None):
+        cachefile = self._cached(ext, data)
+        if os.path.exists(cachefile) or self.jobs <= 1:
+            self._write(outfile, self.minify(ext, data), manifest, source)
+            return
+        if self.pool is None:
+            import multiprocessing
+            self.pool = multiprocessing.Pool(self.jobs)
+        self.pending.append((outfile, cachefile, manifest, source,
+            self.pool.apply_async(_minify, ((ext, data),))))
+        # finished pages are written as we go, so that a big build
+        # doesn't hold every page in memory
+        while len(self.pending) > 8 * self.jobs or \
+        (self.pending and self.pending[0][4].ready()):
+            self._collect()
+
+    def _collect(self):
+        outfile, cachefile, manifest, source, result = self.pending.pop(0)
+        res = result.get()
+        self._store(cachefile, res)
+        self._write(outfile, res, manifest, source)
+
+    def _write(self, outfile, res, manifest, source):
+        fp = open(outfile, "w")
+        fp.write(res)
+        fp.close()
+        if manifest is not None:
+            infile, stamp, tmpl = source
+            manifest.append(_manifest_entry(outfile, res, infile, stamp, tmpl))
 
+    def finish(self):
         try:
-            fp = open(outfile, "r")
-            tstamp = stampof(fp)
+            while self.pending:
+                self._collect()
+        finally:
+            if self.pool is not None:
+                self.pool.close()
+                self.pool.join()
+                self.pool = None
+        if self.hashes_changed:
+            self._savehashes()
+
+    def abort(self):
+        # stops the workers; pages not yet written are lost
+        self.pending = []
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+
+    def _hash(self, path, st):
+        # content hashes are kept by path, size and time, so unchanged
+        # assets aren't read on every build
+        import hashlib
+        if self.hashes is None:
+            self._loadhashes()
+        key = os.path.abspath(path)
+        e = self.hashes.get(key)
+        if e is not None and e[0] == st[stat.ST_SIZE] \
+        and e[1] == st[stat.ST_MTIME]:
+            return e[2]
+        fp = open(path, "rb")
+        digest = hashlib.sha1(fp.read()).hexdigest()
+        fp.close()
+        self.hashes[key] = (st[stat.ST_SIZE], st[stat.ST_MTIME], digest)
+        self.hashes_changed = 1
+        return digest
+
+    def _loadhashes(self):
+        self.hashes = {}
+        try:
+            fp = open(os.path.join(self.cachedir, "assets"), "r")
+        except IOError:
+            return
+        for line in fp.readlines():
+            size, mtime, digest, path = string.split(line[:-1], "\t", 3)
+            self.hashes[path] = (int(size), int(mtime), digest)
+        fp.close()
+
+    def _savehashes(self):
+        lines = []
+        for path, e in self.hashes.items():
+            lines.append("%d\t%d\t%s\t%s\n" % (e[0], e[1], e[2], path))
+        lines.sort()
+        self._store(os.path.join(self.cachedir, "assets"),
+            string.join(lines, ""))
+        self.hashes_changed = 0
+
+    def fingerprint(self, patterns, anchor, minify = ""):
+        """fingerprint(patterns, anchor, minify)
+
+        Copies each file matching the glob patterns, relative to the
+        directory anchor, to a name with the first ten digits of its
+        SHA-1 before the extension (minifying it, if its extension is
+        listed in minify), and removes older fingerprinted copies.
+        Returns a dictionary of paths relative to anchor, original to
+        fingerprinted, and the newest time stamp of the copies.
+        """
+        import glob
+        minify = string.split(string.lower(minify))
+        fmap = {}
+        newest = 0
+        for pat in string.split(patterns):
+            for path in glob.glob(os.path.join(anchor, pat)):
+                root, ext = os.path.splitext(path)
+                if not os.path.isfile(path) or _fingerprinted.search(root):
+                    continue
+                digest = self._hash(path, os.stat(path))
+                fpath = "%s.%s%s" % (root, digest[:10], ext)
+                if not os.path.exists(fpath):
+                    fp = open(path, "rb")
+                    data = fp.read()
+                    fp.close()
+                    e = _extof(path)
+                    if _minifiers.has_key(e) and e in minify:
+                        data = self.minify(e, data)
+                    fp = open(fpath, "wb")
+                    fp.write(data)
+                    fp.close()
+                    print path, "->", fpath
+                    for old in glob.glob(root + ".*" + ext):
+                        if old != fpath and _fingerprinted.search(old[:-len(ext) or None]):
+                            os.remove(old)
+                newest = max(newest, os.stat(fpath)[stat.ST_MTIME])
+                rel = os.path.relpath(path, anchor)
+                fmap[rel] = os.path.relpath(fpath, anchor)
+        return fmap, newest
+
+    def assets(self, patterns, anchor, pagedir, minify = ""):
+        # the asset macros for pages written to pagedir, as a Template
+        # layer; its _stamp is that of the newest fingerprinted copy
+        anchor = os.path.normpath(anchor)
+        pagedir = os.path.normpath(pagedir)
+        key = (patterns, anchor, pagedir)
+        layer = self.layers.get(key)
+        if layer is not None:
+            return layer
+        if not self.maps.has_key((patterns, anchor)):
+            self.maps[(patterns, anchor)] = self.fingerprint(patterns,
+                anchor, minify)
+        fmap, newest = self.maps[(patterns, anchor)]
+        layer = Template()
+        for rel, frel in fmap.items():
+            url = os.path.relpath(os.path.join(anchor, frel), pagedir)
+            layer["asset:" + string.replace(rel, os.sep, "/")] = \
+                string.replace(url, os.sep, "/")
+        layer["_stamp"] = newest
+        self.layers[key] = layer
+        return layer
+
+
+######################################################################
+# sharded builds and manifests
+######################################################################
+
+def ParseShard(spec):
+    # "i/N" -> (i, N)
+    try:
+        i, n = map(int, string.split(spec, "/"))
+    except ValueError:
+        raise DataError, "bad shard spec: " + `spec`
+    if n < 1 or i < 0 or i >= n:
+        raise DataError, "bad shard spec: " + `spec`
+    return (i, n)
+
+def InShard(filename, shard):
+    # crc32 of the name, so every machine agrees on the partition
+    import zlib
+    return (zlib.crc32(filename) & 0xffffffffL) % shard[1] == shard[0]
+
+def _manifest_entry(outfile, data, infile, srcstamp, tmpl):
+    import hashlib
+    if not tmpl.has_key("_sha1"):
+        # stamps differ from machine to machine; content doesn't
+        try:
+            fp = open(tmpl["_filename"], "rb")
+            tmpl["_sha1"] = hashlib.sha1(fp.read()).hexdigest()
             fp.close()
-        except:
-            tstamp = 0
+        except (KeyError, IOError):
+            tmpl["_sha1"] = "-"
+    return (os.path.normpath(outfile), hashlib.sha1(data).hexdigest(),
+        infile, srcstamp, tmpl.get("_filename", ""), tmpl["_stamp"],
+        tmpl["_sha1"], len(data))
+
+def SaveManifest(filename, entries, shard = None):
+    """SaveManifest(filename, entries, shard)
+
+    A manifest lists the output files of a build, one per line:
+
+        output  sha1  input  input-stamp  template  template-stamp  template-sha1  size
+
+    separated by tabs, with paths relative to the build directory; size
+    is that of the output, so that a user such as publish.py can tell
+    when the file has been rebuilt since (older manifests lack it, and
+    it is read as -1).  The first line records which shard produced it,
+    if any.
+    """
+    fp = open(filename, "w")
+    if shard is None:
+        fp.write("# makesite manifest\n")
+    else:
+        fp.write("# makesite manifest shard %d/%d\n" % shard)
+    for e in entries:
+        fp.write("%s\t%s\t%s\t%d\t%s\t%d\t%s\t%d\n" % e)
+    fp.close()
+
+def LoadManifest(filename):
+    fp = open(filename, "r")
+    head = fp.readline()
+    if head[:19] != "# makesite manifest":
+        fp.close()
+        raise DataError, filename + ": not a makesite manifest"
+    shard = None
+    words = string.split(head)
+    if len(words) == 5 and words[3] == "shard":
+        shard = ParseShard(words[4])
+    entries = []
+    for line in fp.readlines():
+        e = string.split(line[:-1], "\t")
+        if len(e) == 7:
+            e.append("-1")
+        if len(e) != 8:
+            fp.close()
+            raise DataError, "%s: bad manifest line: %s" % (filename, `line`)
+        entries.append((e[0], e[1], e[2], int(e[3]), e[4], int(e[5]), e[6],
+            int(e[7])))
+    fp.close()
+    return shard, entries
+
+def MergeManifests(outfile, infiles):
+    """MergeManifests(outfile, infiles)
+
+    Combines the manifests written by the shards of one build.  Every
+    shard 0..N-1 must be present exactly once, no output may be claimed
+    twice, and all shards must have used the same version of each
+    template; otherwise DataError is raised and nothing is written.
+    Returns the number of entries written.
+    """
+    seen = {}
+    outputs = {}
+    templates = {}
+    merged = []
+    count = None
+    for fn in infiles:
+        shard, entries = LoadManifest(fn)
+        if shard is None:
+            raise DataError, fn + ": not a shard manifest"
+        if count is None:
+            count = shard[1]
+        if shard[1] != count:
+            raise DataError, "%s: shard %d/%d, expected N=%d" \
+                % (fn, shard[0], shard[1], count)
+        if seen.has_key(shard[0]):
+            raise DataError, "%s: shard %d/%d also read from %s" \
+                % (fn, shard[0], shard[1], seen[shard[0]])
+        seen[shard[0]] = fn
+        for e in entries:
+            if outputs.has_key(e[0]):
+                raise DataError, "%s: %s also built by %s" \
+                    % (fn, e[0], outputs[e[0]])
+            outputs[e[0]] = fn
+            if templates.get(e[4], e[6]) != e[6]:
+                raise DataError, "%s: template %s differs between shards" \
+                    % (fn, e[4])
+            templates[e[4]] = e[6]
+            merged.append(e)
+    if count is None:
+        raise DataError, "no manifests to merge"
+    if len(seen) != count:
+        missing = filter(lambda i, seen = seen: not seen.has_key(i), range(count))
+        raise DataError, "missing shards: " + string.join(map(str, missing), ", ")
+    merged.sort()
+    SaveManifest(outfile, merged)
+    return len(merged)
+
+
+def Build(template_file = "template.*", filenames = None, directory = None,
+          module_file = "module.site", norc = 0, force = 0, verbose = 0,
+          shard = None, manifest = None, recursive = 0, jobs = 4):
+    """Build(...) -- run a complete makesite build in-process
+
+    Does everything the command line tool does, minus option parsing
+    and the pause, and returns the number of pages written.  The current
+    directory is restored afterward, so Build() may be called repeatedly
+    from one process for many sites.  shard is an (i, N) tuple, as from
+    ParseShard(); manifest names a file, relative to the build directory,
+    to list the outputs in.  recursive builds the whole tree below the
+    build directory from one WorkList().  jobs is the number of worker
+    processes used to minify pages.
+    """
+
+    global _verbose, _force, _directory, _module_file, _pipeline
+
+    _verbose = verbose
+    _force = force
+    _module_file = module_file
+
+    import glob
+
+    cwd = os.getcwd()
+    built = 0
+
+    try:
+        if directory:
+            _directory = directory
+            if _verbose:
+                print "change directory to", directory
+            os.chdir(directory)
 
-        if not _force and tstamp > max(msg["_stamp"], tmpl["_stamp"]):
+        if not norc and os.path.exists(".makesite"):
             if _verbose:
-                print "*** skipping", infile
-            continue
+                print "running .makesite"
+            fp = open(".makesite", "r")
+            script = fp.read()
+            fp.close()
+            exec script in {}
+
+        def_ctx = defaultctx()
+
+        _pipeline = Pipeline(jobs)
+
+        entries = None
+        if manifest:
+            entries = []
 
-        print infile, "->", outfile
+        if recursive:
+            for job in WorkList(template_file, module_file, shard, filenames):
+                built += _render(job, entries)
+            template_files = []
+        else:
+            template_files = glob.glob(template_file)
+
+        for t in template_files:
+            print "Processing Template", t
+
+            tmpl = LoadTemplate(t)
+
+            if filenames:
+                for i in filenames:
+                    built += MakeSite(tmpl, i, def_ctx, module_file,
+                                      shard, entries)
+            else:
+                built += MakeSite(tmpl, None, def_ctx, module_file,
+                                  shard, entries)
+
+        _pipeline.finish()
 
-        def_ctx["SrcDate"] = time.strftime("%m/%d/%Y", \
-            time.localtime(os.stat(infile)[stat.ST_MTIME]))
+        if manifest:
+            SaveManifest(manifest, entries, shard)
 
-        res = (tmpl + def_ctx) * msg
+    finally:
+        if _pipeline is not None:
+            _pipeline.abort()
+        _pipeline = None
+        os.chdir(cwd)
 
-        f_out = open(outfile, "w")
-        f_out.write(res)
-        f_out.close()
+    return built
 
 ######################################################################
 # main body
 ######################################################################
 
-if __name__ == '__main__':
-
-    (optlist, args) = getopt.getopt(sys.argv[1:], "fnvpt:d:", \
-        [ "template=", "module=", "dir=", "norc", "pause", "force", "verbose" ])
-    
-    usage = "Usage: makesite [ options ] [ filename...]\n\n" + \
-            "Options: --template=file\n" + \
-            "         --module=file\n" + \
-            "         --dir=directory\n" + \
-            "         --pause\n" + \
-            "         --verbose\n" + \
-            "         --force\n" + \
-            "         --norc\n"
+usage = "Usage: makesite [ options ] [ filename...]\n\n" + \
+        "Options: --template=file\n" + \
+        "         --module=file\n" + \
+        "         --dir=directory\n" + \
+        "         --pause\n" + \
+        "         --verbose\n" + \
+        "         --force\n" + \
+        "         --norc\n" + \
+        "         --recursive\n" + \
+        "         --jobs=n\n" + \
+        "         --timing\n" + \
+        "         --shard=i/N\n" + \
+        "         --manifest=file\n" + \
+        "         --merge=file manifest...\n"
+
+def main(argv = None):
+
+    import getopt
+
+    if argv is None:
+        argv = sys.argv[1:]
+
+    (optlist, args) = getopt.getopt(argv, "fnvprt:d:", \
+        [ "template=", "module=", "dir=", "norc", "pause", "force",
+          "verbose", "recursive", "jobs=", "timing", "shard=", "manifest=", "merge=" ])
     
     template_file = "template.*"
     module_file = "module.site"
 
-    _directory = ""
-    _pause = 0
-    _force = 0
-    _verbose = 0
-    _norc = 0
+    directory = ""
+    pause = 0
+    force = 0
+    verbose = 0
+    norc = 0
+    timing = 0
+    recursive = 0
+    jobs = 4
+    shard = None
+    manifest = None
+    merge = None
     
     for i in optlist:
         if i[0] == '--template' or i[0] == '-t':
@@ -467,49 +1384,71 @@ if __name__ == '__main__':
         elif i[0] == '--module':
             module_file = i[1]
         elif i[0] == '--dir' or i[0] == '-d':
-            _directory = i[1]
+            directory = i[1]
         elif i[0] == '--pause' or i[0] == '-p':
-            _pause = 1
+            pause = 1
         elif i[0] == '--force' or i[0] == '-f':
             force = 1
         elif i[0] == '--verbose' or i[0] == '-v':
-            _verbose = 1
+            verbose = 1
         elif i[0] == '--norc' or i[0] == '-n':
-            _norc = 1
+            norc = 1
+        elif i[0] == '--recursive' or i[0] == '-r':
+            recursive = 1
+        elif i[0] == '--jobs':
+            try:
+                jobs = int(i[1])
+            except ValueError:
+                sys.stderr.write("\nbad --jobs value: %s\n\n" % i[1])
+                sys.stderr.write(usage)
+                return 1
+        elif i[0] == '--timing':
+            timing = 1
+        elif i[0] == '--shard':
+            try:
+                shard = ParseShard(i[1])
+            except DataError, e:
+                sys.stderr.write("\n%s\n\n" % e)
+                sys.stderr.write(usage)
+                return 1
+        elif i[0] == '--manifest':
+            manifest = i[1]
+        elif i[0] == '--merge':
+            merge = i[1]
         else:
             sys.stderr.write("\nArgument [%s] Not Recognized.\n\n" % i[0])
             sys.stderr.write(usage)
-            sys.exit(1)
-    
-    if _directory:
-        if _verbose:
-            print "change directory to", _directory
-        os.chdir(_directory)
+            return 1
     
-    if not _norc and os.path.exists(".makesite"):
-        if _verbose:
-            print "running .makesite"
-        fp = open(".makesite", "r")
-        script = fp.read()
-        fp.close()
-        exec script in {}
+    start = time.time()
 
-    def_ctx = defaultctx()
+    if merge:
+        try:
+            n = MergeManifests(merge, args)
+        except (DataError, IOError), e:
+            sys.stderr.write("makesite: %s\n" % e)
+            return 1
+        print "merged %d manifests, %d outputs, into %s" % (len(args), n, merge)
+        return 0
 
-    template_files = glob.glob(template_file)
+    if shard is not None and not manifest:
+        manifest = ".manifest.%d" % shard[0]
 
-    for t in template_files:
-        print "Processing Template", t
+    Build(template_file, args, directory, module_file, norc, force, verbose,
+          shard, manifest, recursive, jobs)
 
-        tmpl = LoadTemplate(t)
+    if timing:
+        sys.stderr.write("makesite: load %.3fs, build %.3fs\n" \
+            % (_load_time, time.time() - start))
 
-        if len(args) > 0:
-            for i in args:
-                MakeSite(tmpl, i)
-        else:
-            MakeSite(tmpl, None)
-    
-    if _pause:
+    if pause:
         raw_input("\nPress ENTER to Continue... ")
+
+    return 0
+
+_load_time = time.time() - _load_start
+
+if __name__ == '__main__':
+    sys.exit(main())
     
 ######################################################################
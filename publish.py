@@ -50,25 +50,159 @@ variable assignments:
     mode = "ftp"                    # or "copy" to copy the files directly
     lowername = 1                   # change names to lowercase
 
-.index should contain a valid repr() of a dictionary, where the
-keys are filenames and the values are lists containing the timestamps,
-as returned as element 8 of the stat tuple.  The values have to be
-stored in lists because we will be storing a temporary flag there.
+and may also set:
+
+    bandwidth = 0                   # upload cap in bytes per second
+    blocksize = 8192                # upload chunk size
+    largefile = 1048576             # files this size or larger go last
+    firstext = "html htm css js"    # extensions which are sent first
+
+Changed files are not sent in directory order.  They are queued during
+the walk and sent by priority: pages and other files with a firstext
+extension first, then the remaining small files, then large files.
+This way content changes become visible without waiting for big assets.
+
+Setting compress = "gz br" (or either one alone) publishes precompressed
+siblings of text files, such as page.html.gz and page.html.br, for web
+servers which serve them directly.  Only files with a compressext
+extension are compressed.  The variants are built on compressjobs
+threads and cached under .pubcache by content hash, so unchanged files
+are never compressed again.  They are tracked in .index under their own
+names, with the content hash as their stamp, and are uploaded and
+deleted along with their originals.  br requires the brotli module.
+
+Setting manifest to the path of a makesite manifest (such as the one
+makesite.py --merge writes for a sharded build) makes publish.py use the
+content hashes listed there as the stamps of those files, rather than
+their modification times.  Outputs copied in from build machines are
+then only sent when their content has changed.  Paths in the manifest
+are taken relative to the directory the manifest is in.  A file which
+is newer than the manifest, or whose size differs from the one listed,
+has been rebuilt since, and its own modification time is used instead.
+
+Setting delta = 1 sends a changed large file (largefile bytes or more)
+as a delta when the backend can write into an existing file, as the
+SFTP (secure) and copy modes can.  The MD5 of each deltablock-sized
+block of the version last sent is kept under .pubcache/sig.  The new
+version is compared block by block with that, and only the blocks which
+differ are written, in place, after which the file is truncated to its
+new length.  An appended log or a partly regenerated PDF costs only the
+changed blocks.  The server's copy is never read back; its size is
+checked against the cache before a delta is used.
+
+Files which have been removed locally are deleted from the server once
+the uploads are done.  They are grouped by directory and deleted over
+deletejobs sessions at once (default 4; FTP and copy modes), and remote
+directories left empty are removed, deepest first.  A file which can't
+be deleted is reported and kept in .index, so the next run tries again.
+
+With mode = "archive", the changed files are not sent one at a time.
+They are streamed as a single tar archive to a shell on the server,
+unpacked into a staging copy of the directory along with the deletes,
+and the staging copy is then swapped into place.  Nothing changes on the
+server unless the whole archive arrives.  The shell is reached through
+archivecmd if it is set (for example "ssh user@host", or "sh -c" to
+deploy to a local directory); otherwise host, user and pwd are used to
+open an SSH session with paramiko.  The server needs sh, tar and cp.
+
+Publishing is planned before anything is sent.  The local tree is
+compared with .index to give the uploads, the new remote directories
+and the deletes, with a byte total and an estimate of the transfer time
+fitted to the last runs (kept in .pubhistory), and that plan is then
+carried out on whichever backend the mode selects.
+
+    publish.py --plan
+
+(or -n) prints the plan without connecting to the server or changing
+.index.  Publisher.plan() and Publisher.execute() do the same in-process.
+
+Uploads which fail with a transient error (a dropped connection, a 4xx
+reply) are retried up to retries times (default 5), backing off
+exponentially, and resume where they stopped: REST is used for FTP and
+an offset write for SFTP.  The remote size is checked after resumed and
+large uploads.
+When bandwidth is set, uploads are paced in blocksize chunks to stay
+under it; --bandwidth on the command line sets one cap shared by all
+sites in the run.
+
+.index records each published file on one tab-separated line:
+
+    stamp   size    partial-stamp   bytes-sent  ./path/to/file
+
+where stamp is element 8 of the stat tuple (or "h:" and a content hash,
+for compressed variants) and the partial fields are "-" unless an upload
+of the file was interrupted, in which case the next run resumes it.
+The older repr() of a dictionary is still read, and rewritten in the
+new form.
 
 .index won't be found the first time through.
+
+publish.py may also be imported and driven in-process; importing it has
+no side effects:
+
+    import publish
+    pub = publish.PublishSite("website")
+    print pub.rc, pub.uploads, pub.deletes
+
+PublishSite() returns the Publisher which did the work; its rc attribute
+is the exit status the command line tool would have returned.
+
+Several sites may be published from one process by naming their
+directories on the command line:
+
+    publish.py --jobs 8 site1 site2 site3 ...
+
+The sites run concurrently, at most --jobs at a time (default 4), and
+sites on the same host and user share logged-in sessions.  A combined
+summary is printed at the end.  PublishBatch() does the same in-process.
 """
 
 # my version numbers are usually strings
 __version__ = "2.0"
 
-import os, sys
+import time
+
+_load_start = time.time()
+
+import os, sys, string, array, binascii
 
-try:
-    import timeoutsocket
-    timeoutsocket.setDefaultSocketTimeout(60)
-except ImportError:
+##########################################################################
+#  Exceptions
+##########################################################################
+
+class Error:
+    def __init__(self, msg):
+        self.msg = msg
+    def __repr__(self):
+        return repr(self.msg)
+    def __str__(self):
+        return str(self.msg)
+
+class SiteError(Error):
     pass
 
+def _copyfile(src, dst, blocksize, callback):
+    # like shutil.copyfileobj, with ftplib's storbinary() callback
+    while 1:
+        buf = src.read(blocksize or 8192)
+        if not buf:
+            break
+        dst.write(buf)
+        if callback:
+            callback(buf)
+
+def _writeranges(src, dst, ranges, blocksize):
+    # copies the (start, length) ranges of src to the same offsets in dst
+    for start, length in ranges:
+        src.seek(start)
+        dst.seek(start)
+        while length > 0:
+            buf = src.read(min(blocksize or 8192, length))
+            if not buf:
+                break
+            dst.write(buf)
+            length = length - len(buf)
+
 ##########################################################################
 #  NullFTP is used by the touch function
 ##########################################################################
@@ -83,10 +217,9 @@ class NullFTP:
 #  ZipFTP is used in zipping mode
 ##########################################################################
 
-import zipfile, time
-
 class ZipFTP:
     def __init__(self, fn):
+        import zipfile
         self.filename = fn
         self.zipfile = zipfile.ZipFile(fn, "w", zipfile.ZIP_DEFLATED)
         self.dirpath = []
@@ -99,7 +232,8 @@ class ZipFTP:
             self.dirpath = self.dirpath[:-1]
         else:
             self.dirpath.append(d)
-    def storbinary(self, cmd, file, blocksize = None):
+    def storbinary(self, cmd, file, blocksize = None, callback = None, rest = None):
+        import zipfile
         zinfo = zipfile.ZipInfo()
         zinfo.filename = '/'.join(self.dirpath + [ cmd[5:] ])
         zinfo.compress_type = zipfile.ZIP_DEFLATED
@@ -111,6 +245,8 @@ class ZipFTP:
         except:
             zinfo.date_time = (2002, 1, 1, 0, 0, 0)
         self.zipfile.writestr(zinfo, file.read())
+    def size(self, fname):
+        return None
     def voidcmd(self, cmd):
         pass
     def login(self, user, pwd):
@@ -119,6 +255,8 @@ class ZipFTP:
         pass
     def delete(self, fname):
         pass
+    def rmd(self, d):
+        pass
     def quit(self):
         self.zipfile.close()
 
@@ -126,20 +264,38 @@ class ZipFTP:
 #  CopyFTP is used in copy mode
 ##########################################################################
 
-import shutil
-
 class CopyFTP:
-    def __init__(self):
-        pass
+    # CopyFTP keeps its own idea of the "remote" directory rather than
+    # calling os.chdir(), which would pull the local walk along with it.
+    def __init__(self, path = None):
+        if path is None:
+            path = os.getcwd()
+        self.path = path
     def mkd(self, d):
-        os.mkdir(d)
+        os.mkdir(os.path.join(self.path, d))
     def cwd(self, d):
-        os.chdir(d)
-    def storbinary(self, cmd, file, blocksize = None):
-        fname = cmd[5:]
-        fp = open(fname, "w")
-        shutil.copyfileobj(file, fp)
+        self.path = os.path.normpath(os.path.join(self.path, d))
+    def storbinary(self, cmd, file, blocksize = 8192, callback = None, rest = None):
+        fname = os.path.join(self.path, cmd[5:])
+        if rest:
+            fp = open(fname, "r+b")
+            fp.seek(rest)
+            fp.truncate()
+        else:
+            fp = open(fname, "wb")
+        _copyfile(file, fp, blocksize, callback)
         fp.close()
+    def storedelta(self, fname, file, ranges, size, blocksize = 8192):
+        fp = open(os.path.join(self.path, fname), "r+b")
+        try:
+            _writeranges(file, fp, ranges, blocksize)
+            fp.truncate(size)
+        finally:
+            fp.close()
+    def size(self, fname):
+        return os.path.getsize(os.path.join(self.path, fname))
+    def chmod(self, fn, mode):
+        os.chmod(os.path.join(self.path, fn), mode)
     def voidcmd(self, cmd):
         pass
     def login(self, user, pwd):
@@ -147,7 +303,9 @@ class CopyFTP:
     def set_pasv(self, mode):
         pass
     def delete(self, fname):
-        os.remove(fname)
+        os.remove(os.path.join(self.path, fname))
+    def rmd(self, d):
+        os.rmdir(os.path.join(self.path, d))
     def quit(self):
         pass
 
@@ -155,311 +313,2009 @@ class CopyFTP:
 #  SecureFTP provides SFTP (SSH FTP) services using paramiko
 ##########################################################################
 
-try:
-    import paramiko
-
-    class SecureFTP:
-        def __init__(self, hostname, port = 22):
-            self.hostname = hostname
-            self.transport = paramiko.Transport((hostname, port))
-        def mkd(self, d):
-            self.sftp.mkdir(d)
-        def cwd(self, d):
-            self.sftp.chdir(d)
-        def storbinary(self, cmd, file, blocksize = None):
-            fn = cmd[5:]
+class SecureFTP:
+    def __init__(self, hostname, port = 22):
+        try:
+            import paramiko
+        except ImportError:
+            raise NotImplementedError("Secure Login Not Available - paramiko not found.")
+        self.paramiko = paramiko
+        self.hostname = hostname
+        self.transport = paramiko.Transport((hostname, port))
+    def mkd(self, d):
+        self.sftp.mkdir(d)
+    def cwd(self, d):
+        self.sftp.chdir(d)
+    def pwd(self):
+        return self.sftp.normalize(".")
+    def storbinary(self, cmd, file, blocksize = 8192, callback = None, rest = None):
+        fn = cmd[5:]
+        if rest:
+            fp = self.sftp.open(fn, "r+")
+            fp.seek(rest)
+            fp.truncate(rest)
+        else:
             fp = self.sftp.open(fn, "w")
-            shutil.copyfileobj(file, fp)
+        _copyfile(file, fp, blocksize, callback)
+        fp.close()
+    def storedelta(self, fname, file, ranges, size, blocksize = 8192):
+        # rewrites only the given ranges of the file in place
+        fp = self.sftp.open(fname, "r+")
+        try:
+            _writeranges(file, fp, ranges, blocksize)
+            fp.truncate(size)
+        finally:
             fp.close()
-        def chmod(self, fn, mode):
-            self.sftp.chmod(fn, mode)
-        def voidcmd(self, cmd):
-            pass
-        def login(self, user, pwd):
-            self.transport.connect(username=user, password=pwd)
-            self.sftp = paramiko.SFTPClient.from_transport(self.transport)
-        def set_pasv(self, mode):
-            pass
-        def delete(self, fname):
-            self.sftp.remove(fname)
-        def quit(self):
-            if self.transport:
-                self.transport.close()
-                self.transport = None
+    def size(self, fname):
+        return self.sftp.stat(fname).st_size
+    def chmod(self, fn, mode):
+        self.sftp.chmod(fn, mode)
+    def voidcmd(self, cmd):
+        # only NOOP means anything here; like FTP's, it fails on a
+        # session the server has dropped, which is how the pool tests it
+        if string.upper(cmd) != "NOOP":
+            return
+        if self.transport is None or not self.transport.is_active():
+            raise EOFError("SFTP session to %s is closed" % self.hostname)
+        self.sftp.normalize(".")
+    def login(self, user, pwd):
+        self.transport.connect(username=user, password=pwd)
+        self.sftp = self.paramiko.SFTPClient.from_transport(self.transport)
+    def set_pasv(self, mode):
+        pass
+    def delete(self, fname):
+        self.sftp.remove(fname)
+    def rmd(self, d):
+        self.sftp.rmdir(d)
+    def quit(self):
+        if self.transport:
+            self.transport.close()
+            self.transport = None
 
-except ImportError:
 
-    class SecureFTP:
-        def __init__(self, hostname, port = 22):
-            raise NotImplementedError("Secure Login Not Available - paramiko not found.")
+##########################################################################
+#  ArchiveFTP deploys the changes as one tar stream over SSH
+##########################################################################
+
+# Runs on the server.  The live directory is hard-link copied to a
+# staging directory (cheap, and tar replaces files by unlinking them, so
+# the live copies are untouched), the archive is unpacked there, the
+# deletes listed in .publish-deletes (and the directories emptied by them,
+# in .publish-rmdirs) are applied, and the two directories
+# are swapped.  The archive ends with a .publish-commit marker; if that
+# is missing, or anything else fails, the staging directory is removed
+# and the live site is left as it was.
+
+_archive_script = """set -e
+mkdir -p %(directory)s
+d=`cd %(directory)s && pwd`
+s="$d.publish-stage.$$"
+o="$d.publish-old.$$"
+trap 'rm -rf "$s"' EXIT
+cp -al "$d" "$s" 2>/dev/null || { rm -rf "$s"; cp -a "$d" "$s"; }
+tar -xf - -C "$s"
+test -f "$s/.publish-commit"
+rm -f "$s/.publish-commit"
+if [ -f "$s/.publish-deletes" ]; then
+    while IFS= read -r f; do rm -f "$s/$f"; done < "$s/.publish-deletes"
+    rm -f "$s/.publish-deletes"
+fi
+if [ -f "$s/.publish-rmdirs" ]; then
+    while IFS= read -r f; do rmdir "$s/$f" 2>/dev/null || true; done < "$s/.publish-rmdirs"
+    rm -f "$s/.publish-rmdirs"
+fi
+mv "$d" "$o"
+mv "$s" "$d"
+trap - EXIT
+rm -rf "$o"
+"""
+
+class ArchiveFTP:
+    # Either runs the script through archivecmd (such as "ssh user@host",
+    # or "sh -c" to deploy to a local directory), or over a paramiko
+    # session channel, as SecureFTP would connect.
+    def __init__(self, site):
+        self.site = site
+        self.dirpath = []
+        self.deletes = []
+        self.rmdirs = []
+        self.proc = None
+        self.channel = None
+        self.secure = None
+        self.tar = None
+        self.committed = 0
+    def login(self, user, pwd):
+        import pipes, tarfile
+        script = _archive_script % { "directory": pipes.quote(self.site.directory) }
+        if self.site.archivecmd:
+            import shlex, subprocess
+            self.proc = subprocess.Popen(shlex.split(self.site.archivecmd) + [ script ],
+                stdin = subprocess.PIPE)
+            stream = self.proc.stdin
+        else:
+            self.secure = SecureFTP(self.site.host)
+            self.secure.transport.connect(username=user, password=pwd)
+            self.channel = self.secure.transport.open_session()
+            self.channel.exec_command(script)
+            stream = self.channel.makefile("wb")
+        self.stream = stream
+        self.tar = tarfile.open(mode = "w|", fileobj = stream)
+    def mkd(self, d):
+        pass
+    def cwd(self, d):
+        if d == ".":
+            return
+        if d == "..":
+            self.dirpath = self.dirpath[:-1]
+        else:
+            self.dirpath.append(d)
+    def storbinary(self, cmd, file, blocksize = None, callback = None, rest = None):
+        import tarfile
+        info = tarfile.TarInfo('/'.join(self.dirpath + [ cmd[5:] ]))
+        st = os.fstat(file.fileno())
+        info.size = st[6] - file.tell()
+        info.mtime = st[8]
+        info.mode = st[0] & 0777
+        self.tar.addfile(info, file)
+    def size(self, fname):
+        return None
+    def voidcmd(self, cmd):
+        pass
+    def set_pasv(self, mode):
+        pass
+    def delete(self, fname):
+        self.deletes.append(fname)
+    def rmd(self, d):
+        self.rmdirs.append(d)
+    def _member(self, name, data):
+        import tarfile, StringIO
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        info.mtime = time.time()
+        self.tar.addfile(info, StringIO.StringIO(data))
+    def _finish(self):
+        self.tar.close()
+        self.stream.close()
+        if self.proc is not None:
+            rc = self.proc.wait()
+            self.proc = None
+        else:
+            self.channel.shutdown_write()
+            rc = self.channel.recv_exit_status()
+        return rc
+    def commit(self):
+        if self.deletes:
+            self._member(".publish-deletes",
+                string.join(self.deletes, "\n") + "\n")
+        if self.rmdirs:
+            self._member(".publish-rmdirs",
+                string.join(self.rmdirs, "\n") + "\n")
+        self._member(".publish-commit", "")
+        self.committed = 1
+        rc = self._finish()
+        if rc != 0:
+            raise IOError("archive deploy failed, remote exit status %d" % rc)
+    def quit(self):
+        # without commit() the archive has no .publish-commit marker,
+        # and the server throws the staging directory away
+        if not self.committed and self.tar is not None:
+            self.committed = 1
+            try:
+                self._finish()
+            except:
+                pass
+        if self.secure is not None:
+            self.secure.quit()
+            self.secure = None
 
 
 ##########################################################################
-#  Set Variables
+#  Site holds the settings read from a .site file
 ##########################################################################
 
-user = ""
-pwd = ""
-host = ""
-directory = ""
-source = ""
-passive = 0
-chmod = 0
-mode = "ftp"
-zipf = None
-lowername = 0
-secure = None
+class Site:
+
+    user = ""
+    pwd = ""
+    host = ""
+    directory = ""
+    source = ""
+    passive = 0
+    chmod = 0
+    mode = "ftp"
+    zipf = None
+    lowername = 0
+    secure = None
+    bandwidth = 0                   # bytes per second, 0 for no limit
+    blocksize = 8192                # upload chunk size
+    largefile = 1048576             # files this big are sent last
+    firstext = "html htm shtml css js xml txt"
+    retries = 5                     # attempts after a transient error
+    compress = ""                   # "gz", "br" or "gz br"
+    compressext = "html htm shtml css js svg xml txt"
+    compressjobs = 4
+    manifest = ""                   # makesite manifest giving content hashes
+    archivecmd = ""                 # command to reach the server's shell
+    delta = 0                       # 1 to send large files as deltas
+    deltablock = 65536
+    deletejobs = 4                  # sessions used to remove stale files
+
+    def __init__(self, mapping = None):
+        if mapping is not None:
+            for k in mapping.keys():
+                if k[:1] != "_":
+                    setattr(self, k, mapping[k])
+
+
+def LoadSite(filename = "./.site"):
+    g = {}
+    try:
+        execfile(filename, g)
+    except:
+        import traceback
+        raise SiteError("Can't Execute Site File %s\n%s" \
+            % (filename, traceback.format_exc()))
+    return Site(g)
+
 
-rc = 0
+##########################################################################
+#  Functions
+##########################################################################
 
 ##########################################################################
-#  Process command line options
+#  Index records what has been published
 ##########################################################################
 
-import getopt
+class Index:
+    """Index maps file keys ("./dir/name") to the stamp of the version
+    last published, plus its size and any partial upload record.
+
+    There may be millions of entries, so they are not kept as a dict of
+    lists.  A single dict maps each key to a slot number, and the
+    stamps, sizes and seen flags (used by the delete sweep) are kept in
+    flat arrays indexed by slot, so an entry costs its key, one dict
+    entry and a few bytes of array.  Content hashes, which are the
+    stamps of compressed variants, are kept in binary form in a dict by
+    slot; partial uploads are rare and live in a dict by key.  Slots of
+    removed keys are reused.
+
+    Measured with 300,000 entries, this takes 48-51 MB against 70-74 MB
+    for the dict of lists it replaced, whether the files are spread two
+    or thirty thousand to a directory.  Most of what remains is the key
+    strings.  (Splitting keys into interned directory and name parts
+    was tried, and came out larger, at 77-91 MB, because of the cost of
+    each Python object.)  The larger drop in peak memory when loading
+    comes from reading the tab-separated format instead of eval()ing a
+    repr().
+    """
+
+    def __init__(self):
+        self.slots = {}                 # key -> slot
+        self.stamps = array.array("l")
+        self.sizes = array.array("d")
+        self.seen = bytearray()
+        self.free = []                  # slots of removed keys
+        self.hashes = {}                # slot -> binary content hash
+        self.partials = {}              # key -> (stamp, bytes sent)
+
+    def __len__(self):
+        return len(self.slots)
+
+    def _slot(self, key):
+        # the slot of key, adding it with stamp 0 if it's new
+        n = self.slots.get(key)
+        if n is None:
+            if self.free:
+                n = self.free.pop()
+                self.stamps[n] = 0
+                self.sizes[n] = 0
+                self.seen[n] = 0
+            else:
+                n = len(self.stamps)
+                self.stamps.append(0)
+                self.sizes.append(0)
+                self.seen.append(0)
+            self.slots[key] = n
+        return n
+
+    def has_key(self, key):
+        return self.slots.has_key(key)
+
+    __contains__ = has_key
+
+    def keys(self):
+        return self.slots.keys()
+
+    def stamp(self, key, default = 0):
+        n = self.slots.get(key)
+        if n is None:
+            return default
+        h = self.hashes.get(n)
+        if h is not None:
+            return binascii.hexlify(h)
+        return self.stamps[n]
+
+    def size(self, key, default = 0):
+        n = self.slots.get(key)
+        if n is None:
+            return default
+        return int(self.sizes[n])
+
+    def see(self, key):
+        # mark key as still present, adding it with stamp 0 if it's new
+        self.seen[self._slot(key)] = 1
+
+    def update(self, key, stamp, size = 0):
+        # record a published version; this also marks it seen
+        n = self._slot(key)
+        if type(stamp) is type(""):
+            self.hashes[n] = binascii.unhexlify(stamp)
+            self.stamps[n] = 0
+        else:
+            if self.hashes.has_key(n):
+                del self.hashes[n]
+            self.stamps[n] = stamp
+        self.sizes[n] = size
+        if self.partials.has_key(key):
+            del self.partials[key]
+        self.seen[n] = 1
+
+    def partial(self, key):
+        return self.partials.get(key)
+
+    def setpartial(self, key, stamp, sent):
+        self._slot(key)
+        self.partials[key] = (stamp, sent)
+
+    def remove(self, key):
+        n = self.slots[key]
+        del self.slots[key]
+        if self.hashes.has_key(n):
+            del self.hashes[n]
+        if self.partials.has_key(key):
+            del self.partials[key]
+        self.seen[n] = 0
+        self.free.append(n)
+
+    def dirsinuse(self):
+        # the directory keys which hold a file, or have one below them
+        used = {}
+        for key in self.slots.keys():
+            i = key.rfind("/")
+            while i >= 0:
+                dirkey = key[:i]
+                if used.has_key(dirkey):
+                    break
+                used[dirkey] = 1
+                i = dirkey.rfind("/")
+        return used
+
+    def unseen(self):
+        # the keys not marked seen; each may be removed as it is returned
+        seen = self.seen
+        l = []
+        for key, n in self.slots.items():
+            if not seen[n]:
+                l.append(key)
+        return l
+
+    def clearseen(self):
+        self.seen = bytearray(len(self.stamps))
+
+    def contenthashes(self):
+        h = {}
+        for v in self.hashes.values():
+            h[binascii.hexlify(v)] = 1
+        return h
+
+    def Load(self, fp):
+        # the first line identifies the format; older versions of
+        # publish.py saved the repr() of a dict of lists
+        line = fp.readline()
+        if line[:1] == "{":
+            old = eval(line + fp.read())
+            for key in old.keys():
+                e = old[key]
+                self.update(key, e[0])
+                if len(e) >= 4:
+                    self.setpartial(key, e[2], e[3])
+            self.clearseen()
+            return
+        for line in fp:
+            stamp, size, pstamp, sent, key = line[:-1].split("\t", 4)
+            if stamp[:2] == "h:":
+                stamp = stamp[2:]
+            else:
+                stamp = int(stamp)
+            self.update(key, stamp, float(size))
+            if pstamp != "-":
+                if pstamp[:2] == "h:":
+                    pstamp = pstamp[2:]
+                else:
+                    pstamp = int(pstamp)
+                self.setpartial(key, pstamp, int(sent))
+        self.clearseen()
+
+    def Save(self, fp):
+        fp.write("# publish.py index 1\n")
+        partials = self.partials
+        for key, n in self.slots.items():
+            stamp = self.stamp(key)
+            if type(stamp) is type(""):
+                stamp = "h:" + stamp
+            pstamp, sent = "-", "-"
+            p = partials.get(key)
+            if p is not None:
+                pstamp, sent = p
+                if type(pstamp) is type(""):
+                    pstamp = "h:" + pstamp
+            fp.write("%s\t%d\t%s\t%s\t%s\n" % (stamp, self.sizes[n],
+                pstamp, sent, key))
+
+
+def LoadManifest(filename):
+    # maps the full path of each output listed in a makesite manifest
+    # to (content hash, size, time of the manifest); the size is -1 in
+    # manifests from before it was recorded
+    base = os.path.dirname(os.path.abspath(filename))
+    hashes = {}
+    fp = open(filename, "r")
+    try:
+        mtime = os.fstat(fp.fileno())[8]
+        if fp.readline()[:19] != "# makesite manifest":
+            raise SiteError(filename + ": not a makesite manifest")
+        for line in fp:
+            e = line[:-1].split("\t")
+            size = -1
+            if len(e) >= 8:
+                size = int(e[7])
+            hashes[os.path.normpath(os.path.join(base, e[0]))] = \
+                (e[1], size, mtime)
+    finally:
+        fp.close()
+    return hashes
 
-(optlist, args) = getopt.getopt(sys.argv[1:], "qvpt", \
-    [ "quiet", "verbose", "touch", "pause", "zip=" ])
 
-usage = "Usage: publish [ --quiet ] [ --verbose ] [ --touch ] [ --zip filename ] [ --pause ]\n"
+def _manifeststamp(entry, st):
+    # the manifest's hash stands for the file only while the file is as
+    # it was: the same size, and no newer than the manifest itself
+    if entry is None or st[8] > entry[2]:
+        return None
+    if entry[1] >= 0 and entry[1] != st[6]:
+        return None
+    return entry[0]
 
-verbose = 0
-pause = 0
 
-for i in optlist:
-    if i[0] == '--touch' or i[0] == '-t':
-        mode = "touch"
-    elif i[0] == '--pause' or i[0] == '-p':
-        pause = 1
-    elif i[0] == '--verbose' or i[0] == '-v':
-        verbose = 1
-    elif i[0] == '--quiet' or i[0] == '-q':
-        verbose = -1
-    elif i[0] == '--zip':
-        zipf = i[1]
-        mode = "zip"
+def LoadIndex(filename = "./.index"):
+    index = Index()
+    try:
+        fp = open(filename, "r")
+    except IOError:
+        return index
+    try:
+        index.Load(fp)
+    finally:
+        fp.close()
+    return index
+
+
+def SaveIndex(index, filename = "./.index"):
+    fp = open(filename, "w")
+    index.Save(fp)
+    fp.close()
+
+
+def Connect(site, mode, root = None, log = None):
+    if mode == "touch":
+        ftp = NullFTP()
+    elif mode == "zip":
+        ftp = ZipFTP(site.zipf)
+    elif mode == "copy":
+        ftp = CopyFTP(root)
+    elif mode == "archive":
+        if log:
+            log("opening archive stream to " + (site.archivecmd or site.host))
+        ftp = ArchiveFTP(site)
+    elif site.secure:
+        if log:
+            log("secure login to " + site.host)
+        ftp = SecureFTP(site.host)
     else:
-        sys.stderr.write(usage)
-        sys.exit(1)
+        from ftplib import FTP
+        if log:
+            log("logging on to " + site.host)
+        ftp = FTP(site.host)
+
+    ftp.login(site.user, site.pwd)
+
+    ftp.set_pasv(site.passive)
+
+    return ftp
+
 
 ##########################################################################
-#  Load the .site file
+#  ConnectionPool shares logged-in sessions between sites
 ##########################################################################
 
-if not os.path.isfile("./.site"):
-    if os.path.isfile("../.site"):
-        os.chdir("..")
+class ConnectionPool:
+    """Sites published to the same host, as the same user, can share
+    a session.  Each pooled session remembers the directory it logged
+    in to and is returned there on release, so relative .site
+    directories still work.  Only real FTP and SFTP sessions are pooled;
+    the local modes are cheap to set up and are simply closed.
+    """
+
+    def __init__(self):
+        import threading
+        self.lock = threading.Lock()
+        self.idle = {}
+        self.homes = {}
+
+    def key(self, site, mode):
+        if mode != "ftp":
+            return None
+        return (not not site.secure, site.host, site.user, site.pwd, site.passive)
+
+    def acquire(self, site, mode, root = None, log = None):
+        key = self.key(site, mode)
+        while key is not None:
+            self.lock.acquire()
+            try:
+                sessions = self.idle.get(key, [])
+                if not sessions:
+                    break
+                ftp = sessions.pop()
+            finally:
+                self.lock.release()
+            try:
+                # a real round trip, for SFTP as well as FTP
+                ftp.voidcmd("NOOP")
+                if log:
+                    log("reusing session on " + site.host)
+                return ftp
+            except:
+                self.discard(ftp)
+        ftp = Connect(site, mode, root, log)
+        if key is not None:
+            self.homes[id(ftp)] = (key, ftp.pwd())
+        return ftp
+
+    def release(self, ftp, ok = 1):
+        home = self.homes.get(id(ftp))
+        if ok and home is not None:
+            try:
+                ftp.cwd(home[1])
+            except:
+                ok = 0
+        if not ok or home is None:
+            self.discard(ftp)
+            return
+        self.lock.acquire()
+        try:
+            self.idle.setdefault(home[0], []).append(ftp)
+        finally:
+            self.lock.release()
+
+    def discard(self, ftp):
+        if self.homes.has_key(id(ftp)):
+            del self.homes[id(ftp)]
+        try:
+            ftp.quit()
+        except:
+            pass
+
+    def close(self):
+        self.lock.acquire()
+        try:
+            sessions = self.idle.values()
+            self.idle = {}
+        finally:
+            self.lock.release()
+        for l in sessions:
+            for ftp in l:
+                self.discard(ftp)
 
-try:
-    execfile("./.site")
-except:
-    sys.stderr.write("Can't Execute Site File ./.site\n")
-    import traceback
-    traceback.print_exc(file = sys.stderr)
-    if pause:
-        raw_input("\nPress ENTER to Continue... ")
-    sys.exit(1)
 
 ##########################################################################
-#  Imports
+#  Scheduler orders the queued uploads and paces them
 ##########################################################################
 
-from ftplib import FTP, error_temp
-import glob, os.path, string
+class Throttle:
+    def __init__(self, rate):
+        import threading
+        self.rate = float(rate)
+        self.lock = threading.Lock()
+        self.start = time.time()
+        self.sent = 0
+    def wait(self, n):
+        self.lock.acquire()
+        try:
+            now = time.time()
+            # don't save up credit while idle
+            if self.start + self.sent / self.rate < now - 1.0:
+                self.start = now
+                self.sent = 0
+            self.sent = self.sent + n
+            delay = self.start + self.sent / self.rate - now
+        finally:
+            self.lock.release()
+        if delay > 0:
+            time.sleep(delay)
+
+
+class ThrottledFile:
+    def __init__(self, fp, throttle):
+        self.fp = fp
+        self.throttle = throttle
+    def read(self, n = -1):
+        data = self.fp.read(n)
+        self.throttle.wait(len(data))
+        return data
+    def __getattr__(self, attr):
+        return getattr(self.fp, attr)
+
+
+class Upload:
+    def __init__(self, key, filename, dirpath, target, size, stamp, leader):
+        self.key = key
+        self.filename = filename
+        self.dirpath = dirpath
+        self.target = target
+        self.size = size
+        self.stamp = stamp
+        self.leader = leader
+        self.priority = 1
+        self.variant = None
+
+
+class Scheduler:
+
+    # priority classes
+    FIRST = 0
+    NORMAL = 1
+    LARGE = 2
+
+    def __init__(self, site, throttle = None, paced = 1):
+        self.firstext = {}
+        for e in string.split(site.firstext):
+            self.firstext[string.lower(e)] = 1
+        self.largefile = site.largefile
+        self.blocksize = site.blocksize
+        if throttle is None and site.bandwidth:
+            throttle = Throttle(site.bandwidth)
+        if not paced:
+            # local modes are never throttled
+            throttle = None
+        self.throttle = throttle
+        self.queue = []
+
+    def classify(self, job):
+        if job.size >= self.largefile:
+            return self.LARGE
+        name = job.target
+        if job.variant:
+            # compressed variants travel with their originals
+            name = name[:-len(job.variant)-1]
+        ext = string.lower(os.path.splitext(name)[1][1:])
+        if self.firstext.has_key(ext):
+            return self.FIRST
+        return self.NORMAL
+
+    def add(self, job):
+        job.priority = self.classify(job)
+        self.queue.append(job)
+
+    def jobs(self):
+        # large files go smallest first, everything else in tree order
+        l = []
+        for job in self.queue:
+            if job.priority == self.LARGE:
+                l.append((job.priority, job.size, job.key, job))
+            else:
+                l.append((job.priority, 0, job.key, job))
+        l.sort()
+        self.queue = []
+        return map(lambda t: t[-1], l)
+
+    def open(self, job):
+        fp = open(job.filename, "rb")
+        if self.throttle is not None:
+            return ThrottledFile(fp, self.throttle)
+        return fp
 
 
 ##########################################################################
-#  Global Variables
+#  Compressor builds precompressed variants of text files
 ##########################################################################
 
-stack = []
+def _compress(args):
+    # runs on a worker thread; returns the content hash of filename,
+    # building any missing cache files for it
+    import hashlib
+    filename, cachedir, exts = args
+    fp = open(filename, "rb")
+    data = fp.read()
+    fp.close()
+    digest = hashlib.sha1(data).hexdigest()
+    for ext in exts:
+        cachefile = os.path.join(cachedir, digest + "." + ext)
+        if os.path.exists(cachefile):
+            continue
+        if ext == "gz":
+            import gzip, StringIO
+            buf = StringIO.StringIO()
+            gz = gzip.GzipFile("", "wb", 9, buf, 0)
+            gz.write(data)
+            gz.close()
+            out = buf.getvalue()
+        else:
+            import brotli
+            out = brotli.compress(data)
+        tmp = "%s.%s.tmp" % (cachefile, id(args))
+        fp = open(tmp, "wb")
+        fp.write(out)
+        fp.close()
+        os.rename(tmp, cachefile)
+    return digest
+
+
+class Compressor:
+
+    def __init__(self, site, index, root, log):
+        self.index = index
+        self.log = log
+        self.cachedir = os.path.join(root, ".pubcache")
+        self.jobs = site.compressjobs
+        self.textext = {}
+        for e in string.split(site.compressext):
+            self.textext[string.lower(e)] = 1
+        self.exts = []
+        for e in string.split(site.compress):
+            if e == "br":
+                try:
+                    import brotli
+                except ImportError:
+                    log("brotli module not found, not building .br files")
+                    continue
+            elif e != "gz":
+                raise SiteError("unknown compress type: " + e)
+            self.exts.append(e)
+        self.queue = []
+        self.digests = None
+        self.digestfile = os.path.join(self.cachedir, "digests")
+
+    def loaddigests(self):
+        # key -> (stamp, content hash) of each original last compressed
+        self.digests = {}
+        try:
+            fp = open(self.digestfile, "r")
+        except IOError:
+            return
+        for line in fp:
+            stamp, digest, key = line[:-1].split("\t", 2)
+            if stamp[:2] == "h:":
+                stamp = stamp[2:]
+            else:
+                stamp = int(stamp)
+            self.digests[key] = (stamp, digest)
+        fp.close()
 
-uploads = 0
-deletes = 0
-touches = 0
+    def savedigests(self):
+        lines = []
+        for key, (stamp, digest) in self.digests.items():
+            if type(stamp) is type(""):
+                stamp = "h:" + stamp
+            lines.append("%s\t%s\t%s\n" % (stamp, digest, key))
+        tmp = self.digestfile + ".tmp"
+        fp = open(tmp, "w")
+        fp.write(string.join(lines, ""))
+        fp.close()
+        os.rename(tmp, self.digestfile)
+
+    def check(self, key, filename, dirpath, target, stamp, changed, leader,
+              touch):
+        ext = string.lower(os.path.splitext(filename)[1][1:])
+        if not self.exts or not self.textext.has_key(ext):
+            return
+        index = self.index
+        if self.digests is None:
+            self.loaddigests()
+        # the content hash of this version of the original, if it has
+        # been compressed before
+        digest = None
+        last = self.digests.get(key)
+        if last is not None and last[0] == stamp:
+            digest = last[1]
+        exts = []
+        for e in self.exts:
+            vkey = key + "." + e
+            known = index.has_key(vkey)
+            if known:
+                # seen; the stamp is updated when an upload is done
+                index.see(vkey)
+            # a variant whose upload failed after its original's went
+            # through is behind, though the original looks unchanged
+            behind = known and (index.partial(vkey) is not None
+                or (digest is not None and index.stamp(vkey) != digest))
+            if not touch and (changed or not known or behind):
+                index.see(vkey)
+                exts.append(e)
+        if exts:
+            self.queue.append((key, filename, dirpath, target, leader, exts,
+                stamp))
+
+    def run(self):
+        # compress the queued files and return Uploads for the variants
+        # which differ from what was last published
+        if not self.queue:
+            return []
+        if not os.path.isdir(self.cachedir):
+            os.mkdir(self.cachedir)
+        work = []
+        for item in self.queue:
+            work.append((item[1], self.cachedir, item[5]))
+        if self.jobs > 1 and len(work) > 1:
+            from multiprocessing.pool import ThreadPool
+            pool = ThreadPool(min(self.jobs, len(work)))
+            try:
+                digests = pool.map(_compress, work)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            digests = map(_compress, work)
+        uploads = []
+        for item, digest in map(None, self.queue, digests):
+            key, filename, dirpath, target, leader, exts, stamp = item
+            self.digests[key] = (stamp, digest)
+            for e in exts:
+                vkey = key + "." + e
+                if self.index.stamp(vkey) == digest:
+                    continue
+                cachefile = os.path.join(self.cachedir, digest + "." + e)
+                job = Upload(vkey, cachefile, dirpath, target + "." + e,
+                    os.path.getsize(cachefile), digest, leader)
+                job.variant = e
+                uploads.append(job)
+        self.queue = []
+        self.savedigests()
+        return uploads
+
+    def prune(self):
+        # drop cache files no longer named by any variant in the index
+        if not os.path.isdir(self.cachedir):
+            return
+        if self.digests:
+            for key in self.digests.keys():
+                if not self.index.has_key(key):
+                    del self.digests[key]
+            self.savedigests()
+        keep = self.index.contenthashes()
+        for n in os.listdir(self.cachedir):
+            if os.path.isdir(os.path.join(self.cachedir, n)) \
+            or n == "digests":
+                continue
+            if not keep.has_key(string.split(n, ".")[0]):
+                try:
+                    os.remove(os.path.join(self.cachedir, n))
+                except OSError:
+                    pass
 
 
 ##########################################################################
-#  Functions
+#  Signatures caches block checksums for delta transfers
 ##########################################################################
 
-def publish(path, ftp, leader, mode):
-    global stack, uploads, deletes, touches
+class Signatures:
 
-    d = os.path.basename(path)
-    if verbose >= 0:
-        print leader + "publishing directory " + d
+    # SFTP offers no way to copy data from one place on the server to
+    # another, so a block can only be reused where it already is; that
+    # is why blocks are compared at fixed offsets, with no rolling
+    # search for moved ones.
 
-    stack.append(os.getcwd())
-    os.chdir(d)
+    def __init__(self, root, blocksize):
+        self.dir = os.path.join(root, ".pubcache", "sig")
+        self.blocksize = blocksize
 
-    if d[:1] == '%':
-        d = d[1:]
+    def _path(self, key):
+        import hashlib
+        return os.path.join(self.dir, hashlib.sha1(key).hexdigest())
 
-    try:
-        ftp.mkd(d)
-    except:
-        pass
+    def compute(self, filename):
+        import hashlib
+        digests = []
+        fp = open(filename, "rb")
+        try:
+            while 1:
+                buf = fp.read(self.blocksize)
+                if not buf:
+                    break
+                digests.append(hashlib.md5(buf).digest())
+        finally:
+            fp.close()
+        return digests
 
-    ftp.cwd(d)
+    def load(self, key, stamp, size):
+        # the digests saved for key, if they describe that version
+        try:
+            fp = open(self._path(key), "rb")
+        except IOError:
+            return None
+        try:
+            head = fp.readline()
+            data = fp.read()
+        finally:
+            fp.close()
+        if head != "%s\t%d\t%d\n" % (stamp, size, self.blocksize):
+            return None
+        digests = []
+        for i in xrange(0, len(data), 16):
+            digests.append(data[i:i+16])
+        return digests
+
+    def save(self, key, stamp, size, digests):
+        if not os.path.isdir(self.dir):
+            os.makedirs(self.dir)
+        fp = open(self._path(key), "wb")
+        fp.write("%s\t%d\t%d\n" % (stamp, size, self.blocksize))
+        fp.write(string.join(digests, ""))
+        fp.close()
 
-    dirlist = glob.glob("*")
-    dirlist.sort()
+    def remove(self, key):
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
 
-    for n in dirlist:
 
-        if n == "RCS":
-            continue
+##########################################################################
+#  DeletePlan groups the stale files of a sweep by directory
+##########################################################################
 
-        key = path + "/" + n
-        t = n
-        if t[:1] == "%":
-            t = t[1:]
-        if lowername:
-            t = t.lower()
+class DeletePlan:
+    """The files left in the index but no longer in the local tree,
+    grouped by remote directory.  Each group is one unit of work for
+    the delete sessions; once the deletes are done, prunable() lists the
+    remote directories which they emptied.
+    """
+
+    def __init__(self, keys, lowername = 0):
+        self.groups = {}                # remote dir -> [ (key, remote path) ]
+        self.dirkeys = {}               # remote dir -> local directory key
+        self.count = 0
+        for key in keys:
+            # remote names lose a leading %, as in Publisher.publish()
+            parts = key.split("/")[1:]
+            for i in range(len(parts)):
+                if parts[i][:1] == "%":
+                    parts[i] = parts[i][1:]
+            if lowername:
+                parts[-1] = parts[-1].lower()
+            remotedir = string.join(parts[:-1], "/")
+            if not self.groups.has_key(remotedir):
+                self.groups[remotedir] = []
+                self.dirkeys[remotedir] = key[:key.rfind("/")]
+            self.groups[remotedir].append((key, string.join(parts, "/")))
+            self.count = self.count + 1
+
+    def batches(self):
+        # the biggest directories are taken first, so that the sessions
+        # finish at about the same time
+        l = self.groups.values()
+        l.sort(lambda a, b: cmp(len(b), len(a)))
+        return l
+
+    def prunable(self, index, root):
+        # remote directories with no file left under them in the index
+        # and no local counterpart, deepest first
+        used = index.dirsinuse()
+        found = {}
+        for remotedir, dirkey in self.dirkeys.items():
+            while remotedir and not found.has_key(remotedir):
+                found[remotedir] = dirkey
+                remotedir = remotedir[:remotedir.rfind("/")+1][:-1]
+                dirkey = dirkey[:dirkey.rfind("/")]
+        l = []
+        for remotedir, dirkey in found.items():
+            if not used.has_key(dirkey) \
+            and not os.path.isdir(os.path.join(root, dirkey)):
+                l.append((remotedir.count("/"), remotedir))
+        l.sort()
+        l.reverse()
+        return map(lambda e: e[1], l)
 
-        if os.path.isdir(n):
-            publish(key, ftp, leader+" ", mode)
-        else:
-            if index.has_key(key):
-                oldstamp = index[key][0]
+
+##########################################################################
+#  Changeset lists what a publish will do; History times past ones
+##########################################################################
+
+class Changeset:
+    """The work of one publish, as planned by Publisher.plan(): the
+    Uploads in the order they will be sent, the remote directories to
+    create (parents first), and a DeletePlan.  estimate is the expected
+    transfer time in seconds, if there is a History to go by.
+    """
+
+    def __init__(self):
+        self.uploads = []
+        self.mkdirs = []
+        self.deletes = DeletePlan([])
+        self.bytes = 0
+        self.estimate = None
+
+    def report(self, log, detail = 0):
+        if detail:
+            for d in self.mkdirs:
+                log("mkdir   " + d)
+            for job in self.uploads:
+                log("upload  %s (%d bytes)" % (job.key[2:], job.size))
+            for batch in self.deletes.batches():
+                for key, path in batch:
+                    log("delete  " + path)
+        log("%d to upload (%d bytes), %d new directories, %d to delete" \
+            % (len(self.uploads), self.bytes, len(self.mkdirs),
+               self.deletes.count))
+        if self.estimate is not None and self.uploads:
+            log("estimated transfer time %s" % _duration(self.estimate))
+
+
+def _duration(seconds):
+    if seconds < 60:
+        return "%.1fs" % seconds
+    seconds = int(seconds + 0.5)
+    if seconds < 3600:
+        return "%dm%02ds" % (seconds / 60, seconds % 60)
+    return "%dh%02dm" % (seconds / 3600, seconds / 60 % 60)
+
+
+class History:
+    """History keeps the uploads, bytes and seconds of the last few
+    transfers of a site, in .pubhistory beside .index, one run a line:
+
+        time    mode    files   bytes   seconds
+
+    and fits transfer time as a cost per file plus a cost per byte, so
+    that both many small files and a few big ones are estimated fairly.
+    """
+
+    keep = 50
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.runs = []
+        try:
+            fp = open(filename, "r")
+        except IOError:
+            return
+        for line in fp.readlines():
+            try:
+                when, mode, files, nbytes, seconds = string.split(line)
+                self.runs.append((float(when), mode, int(files),
+                    float(nbytes), float(seconds)))
+            except ValueError:
+                pass
+        fp.close()
+
+    def add(self, mode, files, nbytes, seconds):
+        self.runs.append((time.time(), mode, files, float(nbytes), seconds))
+        self.runs = self.runs[-self.keep:]
+
+    def save(self):
+        fp = open(self.filename, "w")
+        for run in self.runs:
+            fp.write("%d\t%s\t%d\t%d\t%.3f\n" % run)
+        fp.close()
+
+    def estimate(self, mode, files, nbytes):
+        # least squares fit of seconds = a * files + b * bytes, with a
+        # and b kept positive; None when no run in this mode is known
+        runs = filter(lambda r, mode = mode: r[1] == mode, self.runs)
+        if not runs:
+            return None
+        sff = sbb = sfb = sfs = sbs = ss = sf = sb = 0.0
+        for when, m, f, b, sec in runs:
+            sff = sff + f * f
+            sbb = sbb + b * b
+            sfb = sfb + f * b
+            sfs = sfs + f * sec
+            sbs = sbs + b * sec
+            ss = ss + sec
+            sf = sf + f
+            sb = sb + b
+        det = sff * sbb - sfb * sfb
+        a = b = -1
+        if det > 1e-9 * sff * sbb:
+            a = (sfs * sbb - sbs * sfb) / det
+            b = (sbs * sff - sfs * sfb) / det
+        if a < 0 or b < 0:
+            # too few (or too alike) runs to tell the costs apart
+            if sb > 0:
+                a, b = 0.0, ss / sb
             else:
-                oldstamp = 0
+                a, b = ss / sf, 0.0
+        return a * files + b * nbytes
+
 
-            newstamp = os.stat(n)[8]
+##########################################################################
+#  Publisher walks the local tree and sends it to the server
+##########################################################################
 
-            if mode == "touch":
-                if verbose >= 0:
-                    print leader + "touching " + n
-                touches += 1
+_output_lock = None
+
+class Publisher:
+
+    def __init__(self, site, ftp, index, mode = "ftp", verbose = 0,
+                 root = ".", name = None, throttle = None):
+        self.site = site
+        self.ftp = ftp
+        self.index = index
+        self.mode = mode
+        self.verbose = verbose
+        self.root = root
+        self.name = name
+        self.uploads = 0
+        self.deletes = 0
+        self.deletefailures = 0
+        self.touches = 0
+        self.transfertime = 0.0
+        self.inuse = None
+        self.mkdirs = []
+        self.changes = None
+        self.elapsed = 0.0
+        self.rc = 0
+        self.remote = []
+        self.pool = None
+        self.manifest = None
+        self.scheduler = None
+        self.compressor = None
+        self.signatures = None
+        self.deltasaved = 0
+        if site is not None:
+            self.scheduler = Scheduler(site, throttle, mode in ("ftp", "archive"))
+            if site.compress:
+                self.compressor = Compressor(site, index, root, self.log)
+            if site.delta:
+                self.signatures = Signatures(root, site.deltablock)
+
+    def log(self, msg):
+        if self.name:
+            msg = "[%s] %s" % (self.name, msg)
+        if _output_lock:
+            _output_lock.acquire()
+        try:
+            sys.stdout.write(msg + "\n")
+        finally:
+            if _output_lock:
+                _output_lock.release()
+
+    def publish(self, path, leader):
+        # walks the local tree, queueing changed files on the scheduler
+        # and noting directories the server won't have; nothing is sent
+        index = self.index
+        verbose = self.verbose
+
+        # the local walk works from full paths rather than changing
+        # directory, so several Publishers may run at once.
+        local = os.path.join(self.root, path)
+
+        d = os.path.basename(path)
+        if verbose >= 0:
+            self.log(leader + "publishing directory " + d)
+
+        if d[:1] == '%':
+            d = d[1:]
+
+        if d != ".":
+            self.remote.append(d)
+            # a directory with nothing published below it is new
+            if self.inuse is None or not self.inuse.has_key(path):
+                self.mkdirs.append(string.join(self.remote, "/"))
+
+        dirlist = []
+        for n in os.listdir(local):
+            if n[:1] != ".":
+                dirlist.append(n)
+        dirlist.sort()
+
+        for n in dirlist:
+
+            if n == "RCS":
+                continue
+
+            key = path + "/" + n
+            fn = os.path.join(local, n)
+            t = n
+            if t[:1] == "%":
+                t = t[1:]
+            if self.site.lowername:
+                t = t.lower()
+
+            if os.path.isdir(fn):
+                self.publish(key, leader+" ")
             else:
-                if newstamp != oldstamp:
+                oldstamp = index.stamp(key)
+
+                st = os.stat(fn)
+                newstamp = st[8]
+                if self.manifest is not None:
+                    h = _manifeststamp(self.manifest.get(os.path.normpath(fn)),
+                        st)
+                    if h is not None:
+                        newstamp = h
+
+                if self.compressor:
+                    self.compressor.check(key, fn, tuple(self.remote), t,
+                        newstamp, newstamp != oldstamp, leader,
+                        self.mode == "touch")
+
+                if self.mode == "touch":
                     if verbose >= 0:
-                        print leader + "storing  " + n + " --> " + t
-                    fp = open(n, "rb")
-                    try:
-                        ftp.storbinary("STOR " + t, fp, 1024)
-                    except error_temp:
-                        # try again, one time.
-                        ftp.storbinary("STOR " + t, fp, 1024)
-                    fp.close()
-                    if chmod:
-                        mode = os.stat(n)[0] & 0777
-                        if hasattr(ftp, "chmod"):
-                            ftp.chmod(t, mode)
-                        else:
-                            ftp.voidcmd("SITE CHMOD " + oct(mode) + " " + t)
-                    uploads += 1
+                        self.log(leader + "touching " + n)
+                    self.touches += 1
+                elif newstamp != oldstamp:
+                    # the new stamp is recorded once the upload is done;
+                    # any partial upload record is kept for resuming
+                    self.scheduler.add(Upload(key, fn, tuple(self.remote),
+                        t, st[6], newstamp, leader))
+                    index.see(key)
+                    continue
                 elif verbose > 0:
-                    print leader + "skipping " + n
+                    self.log(leader + "skipping " + n)
+
+                index.update(key, newstamp, st[6])
+
+        if d != ".":
+            self.remote.pop()
+
+    def plan(self):
+        """plan() -- work out what publishing would do, offline
+
+        Walks the local tree against the index and returns a Changeset
+        of the uploads, new directories and deletes, without touching
+        the server.  Compressed variants are built in the local cache,
+        since their content decides whether they are sent.  The index
+        is updated in memory as the walk goes, as before an upload.
+        """
+        self.inuse = self.index.dirsinuse()
+        self.mkdirs = []
+        self.publish(".", " ")
+        if self.compressor:
+            for job in self.compressor.run():
+                self.scheduler.add(job)
+        changes = Changeset()
+        changes.uploads = self.scheduler.jobs()
+        changes.mkdirs = self.mkdirs
+        if self.mode != "zip":
+            changes.deletes = DeletePlan(self.index.unseen(),
+                self.site.lowername)
+        for job in changes.uploads:
+            changes.bytes = changes.bytes + job.size
+        return changes
+
+    def execute(self, changes):
+        """execute(changes) -- carry out a Changeset from plan()
+
+        Works with any backend; self.ftp must be in the publishing
+        directory.
+        """
+        for d in changes.mkdirs:
+            if self.verbose >= 0:
+                self.log("making directory " + d)
+            try:
+                self.ftp.mkd(d)
+            except:
+                pass
+        start = time.time()
+        self.transfer(changes.uploads)
+        self.transfertime = time.time() - start
+        if self.mode != "zip":
+            self.sweep(changes.deletes)
+
+    def chdir(self, dirpath):
+        # move the remote side from self.remote to dirpath, relative to
+        # the publishing directory
+        i = 0
+        while i < len(self.remote) and i < len(dirpath) \
+        and self.remote[i] == dirpath[i]:
+            i = i + 1
+        while len(self.remote) > i:
+            self.ftp.cwd("..")
+            self.remote.pop()
+        for d in dirpath[i:]:
+            try:
+                self.ftp.cwd(d)
+            except:
+                # the index says it's there, but it isn't
+                try:
+                    self.ftp.mkd(d)
+                except:
+                    pass
+                self.ftp.cwd(d)
+            self.remote.append(d)
+
+    def transfer(self, uploads = None):
+        ftp = self.ftp
+
+        if uploads is None:
+            uploads = self.scheduler.jobs()
+
+        for job in uploads:
+            if self.verbose >= 0:
+                self.log(job.leader + "storing  " + job.key[2:] \
+                    + " --> " + job.target)
+            self.store(job)
+            ftp = self.ftp
+            if self.site.chmod:
+                perm = os.stat(job.filename)[0] & 0777
+                if hasattr(ftp, "chmod"):
+                    ftp.chmod(job.target, perm)
+                else:
+                    ftp.voidcmd("SITE CHMOD " + oct(perm) + " " + job.target)
+            self.index.update(job.key, job.stamp, job.size)
+            self.uploads += 1
+
+        self.chdir(())
+
+    def store(self, job):
+        # a partial upload of this same version of the file may be
+        # resumed; anything else starts from the beginning.
+        partial = self.index.partial(job.key)
+        resume = partial is not None and partial[0] == job.stamp
+
+        errors = _transient_errors()
+        if self.mode == "archive":
+            # a member can't be sent twice into the stream
+            errors = ()
+        # these come as IOErrors too, but retrying won't help
+        import errno
+        permanent = (errno.EACCES, errno.EPERM, errno.ENOSPC)
+        attempt = 0
+        stale = 0
+
+        # after a failed delta the server's copy is in an unknown state,
+        # so the retry sends the whole file
+        usedelta = self.deltaok(job) and not resume
+        indelta = 0
+
+        while 1:
+            try:
+                # a failed reconnect counts as a failed attempt
+                if stale:
+                    self.reconnect()
+                    stale = 0
+                self.chdir(job.dirpath)
+                if usedelta:
+                    indelta = 1
+                    if self.senddelta(job):
+                        return
+                    indelta = 0
+                    usedelta = 0
+                offset = 0
+                if resume:
+                    offset = self.remotesize(job.target) or 0
+                    if offset > job.size:
+                        offset = 0
+                    if offset and self.verbose >= 0:
+                        self.log(job.leader + "resuming " + job.key[2:] \
+                            + " at %d" % offset)
+                self.send(job, offset)
+                if resume or job.size >= self.site.largefile:
+                    size = self.remotesize(job.target)
+                    if size is not None and size != job.size:
+                        raise IOError("%s: remote size %d, expected %d" \
+                            % (job.target, size, job.size))
+                if self.deltaok(job):
+                    self.signatures.save(job.key, job.stamp, job.size,
+                        self.signatures.compute(job.filename))
+                return
+            except errors, e:
+                attempt = attempt + 1
+                if attempt > self.site.retries \
+                        or getattr(e, "errno", None) in permanent:
+                    raise
+                delay = min(2 ** (attempt - 1), 60)
+                if self.verbose >= 0:
+                    self.log(job.leader + "error storing %s (%s), retry %d in %ds" \
+                        % (job.key[2:], e, attempt, delay))
+                time.sleep(delay)
+                if indelta:
+                    self.signatures.remove(job.key)
+                    usedelta = indelta = 0
+                else:
+                    resume = 1
+                stale = 1
+
+    def deltaok(self, job):
+        return self.signatures is not None \
+            and hasattr(self.ftp, "storedelta") \
+            and job.size >= self.site.largefile
+
+    def senddelta(self, job):
+        # sends job as the blocks which differ from the version last
+        # published; returns 0, having sent nothing, if that version's
+        # signatures aren't known or don't match the server
+        sigs = self.signatures
+        oldsize = self.index.size(job.key)
+        old = sigs.load(job.key, self.index.stamp(job.key), oldsize)
+        if old is None or self.remotesize(job.target) != oldsize:
+            return 0
+        new = sigs.compute(job.filename)
+        bs = sigs.blocksize
+        ranges = []
+        for i in xrange(len(new)):
+            if i < len(old) and old[i] == new[i]:
+                continue
+            start = i * bs
+            length = min(bs, job.size - start)
+            if ranges and ranges[-1][0] + ranges[-1][1] == start:
+                ranges[-1] = (ranges[-1][0], ranges[-1][1] + length)
+            else:
+                ranges.append((start, length))
+        sent = 0
+        for r in ranges:
+            sent = sent + r[1]
+        if self.verbose >= 0:
+            self.log(job.leader + "delta    %s: %d of %d bytes changed" \
+                % (job.key[2:], sent, job.size))
+        fp = self.scheduler.open(job)
+        try:
+            self.ftp.storedelta(job.target, fp, ranges, job.size,
+                self.scheduler.blocksize)
+        finally:
+            fp.close()
+        size = self.remotesize(job.target)
+        if size is not None and size != job.size:
+            raise IOError("%s: remote size %d, expected %d" \
+                % (job.target, size, job.size))
+        sigs.save(job.key, job.stamp, job.size, new)
+        self.deltasaved = self.deltasaved + job.size - sent
+        return 1
+
+    def send(self, job, offset):
+        index = self.index
+        sent = [ offset ]
+        index.setpartial(job.key, job.stamp, offset)
+
+        def progress(buf):
+            sent[0] = sent[0] + len(buf)
+            index.setpartial(job.key, job.stamp, sent[0])
+
+        fp = self.scheduler.open(job)
+        try:
+            fp.seek(offset)
+            self.ftp.storbinary("STOR " + job.target, fp,
+                self.scheduler.blocksize, progress, offset or None)
+        finally:
+            fp.close()
+
+    def remotesize(self, fname):
+        try:
+            self.ftp.voidcmd("TYPE I")
+            return self.ftp.size(fname)
+        except:
+            return None
+
+    def reconnect(self):
+        # only a real session can go stale; the local modes just retry
+        if self.pool is None or self.mode != "ftp":
+            return
+        if self.ftp is not None:
+            self.pool.release(self.ftp, 0)
+            self.ftp = None
+        self.ftp = self.pool.acquire(self.site, self.mode, self.root, self.log)
+        self.ftp.cwd(self.site.directory)
+        self.remote = []
+
+    def sweep(self, plan = None):
+        # removes the files which have left the local tree, a directory
+        # at a time, on deletejobs sessions at once where sessions are
+        # pooled; files which can't be removed stay in the index, so the
+        # next run tries them again.  Directories emptied are removed
+        # afterward, deepest first.
+        index = self.index
+        if self.verbose >= 0:
+            self.log("removing outdated files")
+
+        if plan is None:
+            plan = DeletePlan(index.unseen(), self.site.lowername)
+        done = []
+        failed = []
+
+        batches = plan.batches()
+        if self.pool is not None and self.mode in ("ftp", "copy") \
+        and self.site.deletejobs > 1 and len(batches) > 1:
+            self.deletemany(batches, done, failed)
+        else:
+            for batch in batches:
+                self.ftp = self.deletebatch(self.ftp, batch, done, failed)
+
+        for key in done:
+            index.remove(key)
+            if self.signatures is not None:
+                self.signatures.remove(key)
+            self.deletes += 1
+
+        for key, path, e in failed:
+            self.log("could not remove %s: %s" % (path, e))
+        self.deletefailures = len(failed)
+
+        for d in plan.prunable(index, self.root):
+            try:
+                self.ftp.rmd(d)
+            except:
+                # not empty, most likely: the server has files the
+                # index doesn't know of
+                if self.verbose > 0:
+                    self.log("keeping directory " + d)
+                continue
+            if self.verbose >= 0:
+                self.log("removing directory " + d)
+
+        index.clearseen()
+
+    def deletemany(self, batches, done, failed):
+        import threading
+
+        lock = threading.Lock()
+
+        def worker(ftp = None):
+            own = ftp is None
+            try:
+                while 1:
+                    lock.acquire()
+                    try:
+                        if not batches:
+                            break
+                        batch = batches.pop(0)
+                    finally:
+                        lock.release()
+                    if ftp is None:
+                        ftp = self.session()
+                    ftp = self.deletebatch(ftp, batch, done, failed)
+            finally:
+                if own and ftp is not None:
+                    self.pool.release(ftp)
+            return ftp
+
+        def run():
+            try:
+                worker()
+            except:
+                # the batches left are picked up by the other sessions
+                if self.verbose >= 0:
+                    self.log("delete session failed: %s" % sys.exc_info()[1])
+
+        threads = []
+        for i in range(min(self.site.deletejobs, len(batches)) - 1):
+            t = threading.Thread(target = run)
+            t.start()
+            threads.append(t)
+
+        # this session does its share too
+        self.ftp = worker(self.ftp)
+
+        for t in threads:
+            t.join()
+
+    def session(self, old = None):
+        # a pooled session in the publishing directory, replacing old
+        if old is not None:
+            self.pool.release(old, 0)
+        ftp = self.pool.acquire(self.site, self.mode, self.root, self.log)
+        ftp.cwd(self.site.directory)
+        return ftp
+
+    def deletebatch(self, ftp, batch, done, failed):
+        # deletes one directory's files, by their paths relative to the
+        # publishing directory; returns the session, which is replaced
+        # if it fails with a transient error
+        import errno
+        errors = _transient_errors()
+        # SFTP reports these as IOErrors too, but a new session won't help
+        denied = (errno.EACCES, errno.EPERM)
+        for key, path in batch:
+            if self.verbose >= 0:
+                self.log("removing " + path)
+            tries = 0
+            while 1:
+                try:
+                    ftp.delete(path)
+                    done.append(key)
+                except:
+                    e = sys.exc_info()[1]
+                    # a file which is already gone counts as removed
+                    if getattr(e, "errno", None) == errno.ENOENT:
+                        done.append(key)
+                    elif isinstance(e, errors) and tries == 0 \
+                    and self.mode == "ftp" and self.pool is not None \
+                    and getattr(e, "errno", None) not in denied \
+                    and not self.alive(ftp):
+                        tries = 1
+                        ftp = self.session(ftp)
+                        continue
+                    elif self.remotemissing(ftp, path):
+                        done.append(key)
+                    else:
+                        failed.append((key, path, e))
+                break
+        return ftp
+
+    def alive(self, ftp):
+        try:
+            ftp.voidcmd("NOOP")
+        except:
+            return 0
+        return 1
+
+    def remotemissing(self, ftp, fname):
+        # true only when a working session is told plainly that fname
+        # isn't there: ENOENT, or a 550 reply to SIZE or NLST.  Anything
+        # else, such as a server without SIZE, is not proof.
+        import errno, ftplib
+        if not self.alive(ftp):
+            return 0
+        try:
+            ftp.voidcmd("TYPE I")
+            ftp.size(fname)
+            return 0
+        except ftplib.error_perm, e:
+            if str(e)[:3] == "550":
+                return 1
+        except EnvironmentError, e:
+            return e.errno == errno.ENOENT
+        except:
+            return 0
+        # SIZE isn't implemented; ask for a listing instead
+        if not hasattr(ftp, "nlst"):
+            return 0
+        try:
+            ftp.nlst(fname)
+        except ftplib.error_perm, e:
+            return str(e)[:3] == "550"
+        except:
+            pass
+        return 0
+
 
-            index[key] = [ newstamp, 1 ]
+def _transient_errors():
+    import ftplib, socket
+    errors = (ftplib.error_temp, socket.error, IOError, EOFError)
+    try:
+        import paramiko
+        errors = errors + (paramiko.SSHException,)
+    except ImportError:
+        pass
+    return errors
 
-    if d != ".":
-        os.chdir(stack.pop())
-        ftp.cwd("..")
 
-### main body ###
+def PublishSite(sitedir = ".", mode = None, zipf = None, verbose = 0,
+                pool = None, name = None, throttle = None, plan = 0):
+    """PublishSite(...) -- publish one site in-process
 
-try:
-    if source:
-        if verbose >= 0:
-            print "changing local directory to " + source
-        os.chdir(source)
+    sitedir is the directory holding the .site file (or one of its
+    immediate subdirectories, as with the command line tool).  The .site
+    file is loaded fresh for each call; the current directory is never
+    changed.  Sessions come from pool if one is given, so that sites on
+    the same server can share a login.  A Throttle given as throttle
+    overrides the bandwidth setting in the .site file.  Returns the
+    Publisher; a .site file which can't be executed raises SiteError.
+    The Changeset which was carried out is its changes attribute.  With
+    plan set, the changes are only listed: the server isn't contacted
+    and the index isn't saved.
+    """
+
+    start = time.time()
+
+    sitedir = os.path.abspath(sitedir)
+
+    if not os.path.isfile(os.path.join(sitedir, ".site")):
+        if os.path.isfile(os.path.join(sitedir, "..", ".site")):
+            sitedir = os.path.dirname(sitedir)
+
+    site = LoadSite(os.path.join(sitedir, ".site"))
+
+    if zipf is not None:
+        site.zipf = zipf
+        mode = "zip"
+    if mode is None:
+        mode = site.mode
+
+    root = os.path.join(sitedir, site.source)
+    indexfile = os.path.join(root, ".index")
+
+    if site.zipf:
+        site.zipf = os.path.join(root, site.zipf)
 
     # load the index
 
-    index = {}
+    index = Index()
+    if mode != "zip":
+        index = LoadIndex(indexfile)
 
-    if zipf is None:
-        try:
-            fp = open("./.index", "r")
-            indexdata = fp.read()
-            fp.close()
-            index = eval(indexdata)
-        except:
-            pass
+    pub = Publisher(site, None, index, mode, verbose, root, name, throttle)
+
+    history = History(os.path.join(root, ".pubhistory"))
+
+    private = pool is None
+    if private:
+        pool = ConnectionPool()
+
+    pub.pool = pool
+
+    try:
+        if site.source and verbose >= 0:
+            pub.log("changing local directory to " + site.source)
+
+        if site.manifest:
+            pub.manifest = LoadManifest(os.path.join(sitedir, site.manifest))
+
+        pub.changes = changes = pub.plan()
+        changes.estimate = history.estimate(mode, len(changes.uploads),
+            changes.bytes)
+
+        if plan:
+            changes.report(pub.log, verbose >= 0)
+            if private:
+                pool.close()
+            pub.elapsed = time.time() - start
+            return pub
 
-    if mode == "touch":
-        ftp = NullFTP()
-    elif mode == "zip":
-        ftp = ZipFTP(zipf)
-    elif mode == "copy":
-        ftp = CopyFTP()
-    elif secure:
         if verbose >= 0:
-            print "secure login to " + host
-        ftp = SecureFTP(host)
-    else:
+            changes.report(pub.log)
+
+        log = None
         if verbose >= 0:
-            print "logging on to " + host
-        ftp = FTP(host)
+            log = pub.log
 
-    ftp.login(user, pwd)
+        pub.ftp = ftp = pool.acquire(site, mode, root, log)
 
-    ftp.set_pasv(passive)
+        if mode not in ("zip", "archive"):
+            if verbose >= 0:
+                pub.log("set directory to " + site.directory)
+            try:
+                ftp.mkd(site.directory)
+            except:
+                pass
+            ftp.cwd(site.directory)
+
+        pub.execute(changes)
+
+        if mode != "zip" and pub.compressor:
+            pub.compressor.prune()
+
+        if mode == "archive":
+            # nothing reaches the live site until this succeeds
+            pub.ftp.commit()
 
-    if mode != "zip":
         if verbose >= 0:
-            print "set directory to " + directory
+            pub.log("done.")
+
+        if pub.uploads > 0:
+            pub.log("uploaded %d" % pub.uploads)
+
+        if pub.touches > 0:
+            pub.log("touched %d" % pub.touches)
+
+        if pub.deletes > 0:
+            pub.log("deleted %d" % pub.deletes)
+
+        if pub.deletefailures > 0:
+            pub.log("failed to delete %d, kept in .index for the next run" \
+                % pub.deletefailures)
+
+        if pub.deltasaved > 0:
+            pub.log("delta transfers saved %d bytes" % pub.deltasaved)
+
+        pool.release(pub.ftp)
+
+    except:
+        import traceback
+        pub.log(traceback.format_exc().rstrip())
+
+        if pub.ftp is not None:
+            pool.release(pub.ftp, 0)
+
+        pub.rc = 1
+
+    if private:
+        pool.close()
+
+    if plan:
+        pass
+    elif mode == "archive" and pub.rc:
+        # an archive deploy is all or nothing
+        pub.log("archive not deployed, .index unchanged")
+    elif mode != "zip":
+        pub.log("saving .index")
+        SaveIndex(pub.index, indexfile)
+
+    if not pub.rc and pub.uploads and mode in ("ftp", "archive", "copy"):
         try:
-            ftp.mkd(directory)
-        except:
+            history.add(mode, pub.uploads, pub.changes.bytes,
+                pub.transfertime)
+            history.save()
+        except IOError:
             pass
-        ftp.cwd(directory)
 
-    publish(".", ftp, " ", mode)
+    pub.elapsed = time.time() - start
+
+    return pub
+
+
+def PublishBatch(sitedirs, jobs = 4, mode = None, verbose = 0, bandwidth = 0,
+                 plan = 0):
+    """PublishBatch(...) -- publish many sites from one process
+
+    Runs PublishSite() for each directory in sitedirs, at most jobs at a
+    time, with one ConnectionPool shared between them.  If bandwidth is
+    given, it caps all of the sites together.  Returns a list
+    of Publishers in the same order as sitedirs; a site whose .site file
+    can't be loaded gets a Publisher with rc 1 and is reported.
+    """
+
+    global _output_lock
+
+    import threading
+
+    _output_lock = threading.Lock()
+
+    pool = ConnectionPool()
+    throttle = None
+    if bandwidth:
+        throttle = Throttle(bandwidth)
+    results = [ None ] * len(sitedirs)
+    queue = range(len(sitedirs))
+    queue.reverse()
+    qlock = threading.Lock()
+
+    def worker():
+        while 1:
+            qlock.acquire()
+            try:
+                if not queue:
+                    return
+                i = queue.pop()
+            finally:
+                qlock.release()
+            name = sitedirs[i]
+            try:
+                results[i] = PublishSite(sitedirs[i], mode, None, verbose,
+                                         pool, name, throttle, plan)
+            except SiteError, e:
+                pub = Publisher(None, None, Index(), mode, verbose, name = name)
+                pub.log(str(e).rstrip())
+                pub.rc = 1
+                results[i] = pub
+
+    threads = []
+    for i in range(max(1, min(jobs, len(sitedirs)))):
+        t = threading.Thread(target = worker)
+        t.start()
+        threads.append(t)
+
+    for t in threads:
+        t.join()
+
+    pool.close()
+
+    _output_lock = None
+
+    return results
+
+
+def Summary(results):
+    lines = [ "%-30s %3s %8s %8s %8s %8s" \
+        % ("site", "rc", "uploaded", "deleted", "touched", "seconds") ]
+    totals = [ 0, 0, 0, 0, 0.0 ]
+    for pub in results:
+        lines.append("%-30s %3d %8d %8d %8d %8.1f" \
+            % (pub.name, pub.rc, pub.uploads, pub.deletes,
+               pub.touches, pub.elapsed))
+        totals[0] = totals[0] + (pub.rc != 0)
+        totals[1] = totals[1] + pub.uploads
+        totals[2] = totals[2] + pub.deletes
+        totals[3] = totals[3] + pub.touches
+        totals[4] = max(totals[4], pub.elapsed)
+    lines.append("%-30s %3d %8d %8d %8d %8.1f" \
+        % ("total (%d sites)" % len(results), totals[0], totals[1],
+           totals[2], totals[3], totals[4]))
+    return string.join(lines, "\n") + "\n"
 
-    if not zipf:
-        if verbose >= 0:
-            print "removing outdated files"
-        for i in index.keys():
-            if len(index[i]) < 2:
-                if verbose >= 0:
-                    print "removing", i
-                try:
-                    ftp.delete(i)
-                except:
-                    pass
-                del index[i]
-                deletes += 1
-            else:
-                index[i] = index[i][:1]
 
-    if verbose >= 0:
-        print "done."
+##########################################################################
+#  Main Body
+##########################################################################
 
-    if uploads > 0:
-        print "uploaded %d" % uploads
+usage = "Usage: publish [ --quiet ] [ --verbose ] [ --touch ] [ --zip filename ] [ --pause ] [ --timing ]\n" + \
+        "               [ --jobs n ] [ --bandwidth bytes/sec ] [ --plan ] [ sitedir ... ]\n"
 
-    if touches > 0:
-        print "touched %d" % touches
+def main(argv = None):
 
-    if deletes > 0:
-        print "deleted %d" % deletes
+    import getopt
 
-    ftp.quit()
+    if argv is None:
+        argv = sys.argv[1:]
 
-except:
-    import traceback
-    traceback.print_exc(file = sys.stdout)
+    try:
+        import timeoutsocket
+        timeoutsocket.setDefaultSocketTimeout(60)
+    except ImportError:
+        pass
 
-    # rewind
+    (optlist, args) = getopt.getopt(argv, "qvptnj:", \
+        [ "quiet", "verbose", "touch", "pause", "zip=", "timing", "jobs=",
+          "bandwidth=", "plan" ])
+
+    mode = None
+    zipf = None
+    verbose = 0
+    pause = 0
+    timing = 0
+    jobs = 4
+    bandwidth = 0
+    plan = 0
+
+    for i in optlist:
+        if i[0] == '--touch' or i[0] == '-t':
+            mode = "touch"
+        elif i[0] == '--pause' or i[0] == '-p':
+            pause = 1
+        elif i[0] == '--verbose' or i[0] == '-v':
+            verbose = 1
+        elif i[0] == '--quiet' or i[0] == '-q':
+            verbose = -1
+        elif i[0] == '--zip':
+            zipf = i[1]
+        elif i[0] == '--timing':
+            timing = 1
+        elif i[0] == '--jobs' or i[0] == '-j':
+            jobs = int(i[1])
+        elif i[0] == '--bandwidth':
+            bandwidth = int(i[1])
+        elif i[0] == '--plan' or i[0] == '-n':
+            plan = 1
+        else:
+            sys.stderr.write(usage)
+            return 1
 
-    while stack:
-        os.chdir(stack.pop())
+    if args and zipf is not None:
+        sys.stderr.write("--zip can't be used with several sites\n")
+        sys.stderr.write(usage)
+        return 1
 
-    rc = 1
+    start = time.time()
 
-if mode != "zip":
-    print "saving .index"
-    fp = open("./.index", "w")
-    fp.write(repr(index))
-    fp.close()
+    if args:
+        results = PublishBatch(args, jobs, mode, verbose, bandwidth, plan)
+        sys.stdout.write("\n" + Summary(results))
+        rc = 0
+        for pub in results:
+            if pub.rc:
+                rc = 1
+    else:
+        throttle = None
+        if bandwidth:
+            throttle = Throttle(bandwidth)
+        try:
+            pub = PublishSite(".", mode, zipf, verbose, None, None, throttle,
+                              plan)
+            rc = pub.rc
+        except SiteError, e:
+            sys.stderr.write(str(e))
+            rc = 1
+
+    if timing:
+        sys.stderr.write("publish: load %.3fs, run %.3fs\n" \
+            % (_load_time, time.time() - start))
+
+    if pause:
+        raw_input("\nPress ENTER to Continue... ")
+
+    return rc
 
-if pause:
-    raw_input("\nPress ENTER to Continue... ")
+_load_time = time.time() - _load_start
 
-sys.exit(rc)
+if __name__ == '__main__':
+    sys.exit(main())
 
 # end of script.
@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+#
+# check_context.py -- check that exec macros see the same mapping
+# through a Context as through the Template copy it replaced
+#
+# Run from this directory; exits nonzero on a mismatch.
+
+import sys, StringIO
+
+sys.path.insert(0, "..")
+
+import makesite
+
+template = """Title: Default Title
+Footer: the footer
+
+<h1><!--%title%--></h1>
+<!--!hook!-->
+<p><!--%extra%--></p>
+<!--%body%-->
+<!--%footer%-->
+"""
+
+source = """Title: Page Title
+
+page body
+"""
+
+hook = '''
+def hook(msg, tmpl):
+    out = []
+    out.append(str("title" in tmpl))
+    out.append(str(tmpl.has_key("missing")))
+    items = tmpl.items()
+    items.sort()
+    out.append(str(map(lambda i: i[0], items)))
+    out.append(str(len(tmpl)))
+    tmpl["extra"] = "set by hook"
+    out.append(tmpl["extra"])
+    del tmpl["footer"]
+    out.append(str("footer" in tmpl))
+    out.append(str(tmpl.get("footer", "gone")))
+    return "\\n".join(out)
+'''
+
+def load(text):
+    return makesite.Template(StringIO.StringIO(text))
+
+def page():
+    mod = makesite.Generic()
+    exec hook in mod.__dict__
+    msg = load(source)
+    msg["_module"] = mod
+    return msg
+
+def main():
+    tmpl = load(template)
+    def_ctx = makesite.Template()
+    def_ctx["Date"] = "01/01/2001"
+    def_ctx["SrcDate"] = ""
+
+    expected = (tmpl + def_ctx) * page()
+    got = makesite.Context(tmpl, def_ctx) * page()
+
+    if got != expected:
+        sys.stderr.write("Context output differs:\n--- Template\n%s\n--- Context\n%s\n" \
+            % (expected, got))
+        return 1
+    if tmpl.has_key("extra") or not tmpl.has_key("footer"):
+        sys.stderr.write("Context changed the shared template\n")
+        return 1
+    print "ok"
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())